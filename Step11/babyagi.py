@@ -1,13 +1,38 @@
 import os
+import time
 import typer
+import random
+import re
+import contextlib
+import functools
+import asyncio
 import pickle
-import pandas as pd
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import threading
+import json
+import numpy as np
+import requests
+import aiohttp
 from dotenv import load_dotenv
 import openai
 import pinecone
 import lancedb
+import lance
 import pyarrow as pa
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 TASK_CREATION_PROMPT = """
@@ -25,65 +50,1078 @@ Return the result as a numbered list, like:
 Start the task list with number {next_task_id}."""
 
 EXECUTION_PROMPT = """
-You are an AI who performs one task based on the following objective: {objective}. Your task: {task}\nResponse:
+You are an AI who performs one task based on the following objective: {objective}.{context} Your task: {task}\nResponse:
+"""
+
+CONTEXT_PROMPT = """
+Take into account these previously completed tasks:
+{context}
 """
 
 
+TASK_COLUMNS = ('id', 'name', 'result')
+
+
 class Task:
-    def __init__(self, name, id=None, result=None, vector=None):
+    __slots__ = ('name', 'id', 'result', '_vector')
+
+    def __init__(self, name=None, id=None, result=None, vector=None):
         self.name = name
         self.id = id
         self.result = result
         self.vector = vector
 
+    @property
+    def vector(self):
+        return self._vector
+
+    @vector.setter
+    def vector(self, vector):
+        self._vector = None if vector is None else np.asarray(vector, dtype=np.float32)
+
+    def metadata(self):
+        return {c: getattr(self, c) for c in TASK_COLUMNS}
+
+
+def tasks_from_arrow(table, columns):
+    return [Task(**dict(zip(columns, row))) for row in zip(*[table[c].to_pylist() for c in columns])]
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = requests_per_minute
+        self.tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = (now - self.updated) / 60
+            self.updated = now
+            self.requests = min(self.requests_per_minute, self.requests + elapsed * self.requests_per_minute) - 1
+            self.tokens = min(self.tokens_per_minute, self.tokens + elapsed * self.tokens_per_minute) - min(
+                tokens, self.tokens_per_minute
+            )
+            return max(0, -60 * self.requests / self.requests_per_minute, -60 * self.tokens / self.tokens_per_minute)
+
+    def acquire(self, tokens):
+        time.sleep(self.reserve(tokens))
+
+    async def aacquire(self, tokens):
+        await asyncio.sleep(self.reserve(tokens))
 
-class OpenAIService:
-    def __init__(self, api_key):
-        openai.api_key = api_key
+
+class RetryingAIService:
+    def __init__(
+        self,
+        embedding_batch_size=512,
+        completion_limiter=None,
+        embedding_limiter=None,
+        max_retries=6,
+        backoff=1.0,
+        max_backoff=60,
+    ):
+        self.embedding_batch_size = embedding_batch_size
+        self.completion_limiter = completion_limiter
+        self.embedding_limiter = embedding_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def call(self, limiter, tokens, request, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if limiter is not None:
+                limiter.acquire(tokens)
+            try:
+                return request(**kwargs)
+            except RETRY_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_delay(attempt))
+
+    async def acall(self, limiter, tokens, request, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if limiter is not None:
+                await limiter.aacquire(tokens)
+            try:
+                return await request(**kwargs)
+            except RETRY_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff_delay(attempt))
 
     def get_ada_embedding(self, text):
-        return openai.Embedding.create(input=[text.replace('\n', ' ')], model='text-embedding-ada-002')['data'][0][
-            'embedding'
-        ]
+        return self.get_ada_embeddings([text])[0]
+
+    async def aget_ada_embedding(self, text):
+        return (await self.aget_ada_embeddings([text]))[0]
+
+
+class OpenAIService(RetryingAIService):
+    def __init__(
+        self,
+        api_key,
+        api_base=None,
+        embedding_batch_size=512,
+        pool_size=16,
+        timeout=60,
+        keepalive_timeout=30,
+        completion_limiter=None,
+        embedding_limiter=None,
+        max_retries=6,
+        backoff=1.0,
+        max_backoff=60,
+    ):
+        super().__init__(embedding_batch_size, completion_limiter, embedding_limiter, max_retries, backoff, max_backoff)
+        self.api_key = api_key
+        self.api_base = api_base
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        openai.requestssession = self.session
+        self.aiosessions = {}
+
+    def use_aiosession(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.aiosessions:
+            self.aiosessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            )
+        openai.aiosession.set(self.aiosessions[loop])
+
+    async def aclose(self):
+        session = self.aiosessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def acall(self, limiter, tokens, request, **kwargs):
+        self.use_aiosession()
+        return await super().acall(limiter, tokens, request, **kwargs)
+
+    def get_ada_embeddings(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.embedding_batch_size):
+            args = self.embedding_args(texts[i : i + self.embedding_batch_size])
+            data = self.call(self.embedding_limiter, self.embedding_tokens(args), openai.Embedding.create, **args)[
+                'data'
+            ]
+            embeddings += [item['embedding'] for item in sorted(data, key=lambda item: item['index'])]
+        return embeddings
+
+    async def aget_ada_embeddings(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.embedding_batch_size):
+            args = self.embedding_args(texts[i : i + self.embedding_batch_size])
+            response = await self.acall(
+                self.embedding_limiter, self.embedding_tokens(args), openai.Embedding.acreate, **args
+            )
+            embeddings += [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+        return embeddings
+
+    def embedding_args(self, texts):
+        return dict(
+            input=[text.replace('\n', ' ') for text in texts],
+            model='text-embedding-ada-002',
+            api_key=self.api_key,
+            api_base=self.api_base,
+            request_timeout=self.timeout,
+        )
+
+    def embedding_tokens(self, args):
+        return sum(len(text) for text in args['input']) // 4 + 1
+
+    def completion_tokens(self, args):
+        return len(args['prompt']) // 4 + args['max_tokens']
+
+    def completion_args(self, prompt, max_tokens, temperature):
+        return dict(
+            engine='text-davinci-003',
+            prompt=prompt,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0,
+            api_key=self.api_key,
+            api_base=self.api_base,
+            request_timeout=self.timeout,
+        )
+
+    def create(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        args = self.completion_args(prompt, max_tokens, temperature)
+        if stream:
+            return self.stream(args)
+        response = self.call(self.completion_limiter, self.completion_tokens(args), openai.Completion.create, **args)
+        return response.choices[0].text.strip()
+
+    def stream(self, args):
+        tokens = self.completion_tokens(args)
+        for chunk in self.call(self.completion_limiter, tokens, openai.Completion.create, stream=True, **args):
+            yield chunk.choices[0].text
+
+    async def acreate(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        args = self.completion_args(prompt, max_tokens, temperature)
+        if stream:
+            return self.astream(args)
+        response = await self.acall(
+            self.completion_limiter, self.completion_tokens(args), openai.Completion.acreate, **args
+        )
+        return response.choices[0].text.strip()
+
+    async def astream(self, args):
+        tokens = self.completion_tokens(args)
+        async for chunk in await self.acall(
+            self.completion_limiter, tokens, openai.Completion.acreate, stream=True, **args
+        ):
+            yield chunk.choices[0].text
+
+
+SIMULATED_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout)
+
+SIMULATED_VERBS = ('Research', 'Analyze', 'Summarize', 'Compare', 'Estimate', 'Map', 'Evaluate', 'Draft', 'Survey')
+
+SIMULATED_TOPICS = (
+    'crop yields',
+    'food distribution networks',
+    'storage losses',
+    'irrigation methods',
+    'local markets',
+    'funding sources',
+    'soil quality',
+    'supply chain risks',
+    'nutrition programs',
+    'policy options',
+)
+
+SIMULATED_WORDS = (
+    'the',
+    'data',
+    'shows',
+    'that',
+    'regional',
+    'production',
+    'improves',
+    'when',
+    'investment',
+    'and',
+    'logistics',
+    'are',
+    'coordinated',
+    'across',
+    'stakeholders',
+    'with',
+    'measurable',
+    'outcomes',
+)
+
+
+class SimulatedAIService(RetryingAIService):
+    def __init__(
+        self,
+        seed=0,
+        dimension=1536,
+        latency=0.0,
+        jitter=0.0,
+        tokens_per_second=None,
+        error_rate=0.0,
+        max_new_tasks=4,
+        embedding_batch_size=512,
+        completion_limiter=None,
+        embedding_limiter=None,
+        max_retries=6,
+        backoff=0.1,
+        max_backoff=2,
+    ):
+        super().__init__(embedding_batch_size, completion_limiter, embedding_limiter, max_retries, backoff, max_backoff)
+        self.seed = seed
+        self.dimension = dimension
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.max_new_tasks = max_new_tasks
+        self.random = random.Random(seed)
+
+    def rng(self, *key):
+        return random.Random(repr((self.seed,) + key))
+
+    def delay(self):
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def token_delay(self):
+        return 0.0 if self.tokens_per_second is None else 1 / self.tokens_per_second
+
+    def fail(self):
+        if self.random.random() < self.error_rate:
+            raise self.random.choice(SIMULATED_ERRORS)('Simulated failure')
+
+    def respond(self, prompt, max_tokens, temperature):
+        rng = self.rng(prompt, max_tokens, temperature)
+        if 'task creation AI' in prompt:
+            return '\n'.join(
+                f'{rng.choice(SIMULATED_VERBS)} {rng.choice(SIMULATED_TOPICS)} in region {rng.randint(1, 99)}'
+                for _ in range(rng.randint(1, self.max_new_tasks))
+            )
+        if 'prioritization AI' in prompt:
+            names = re.search(r'the following tasks: (.*)\. Consider', prompt, re.S).group(1).split(', ')
+            next_task_id = int(re.search(r'Start the task list with number (\d+)', prompt).group(1))
+            rng.shuffle(names)
+            return '\n'.join(f'{next_task_id + i}. {name}' for i, name in enumerate(names))
+        return ' '.join(rng.choice(SIMULATED_WORDS) for _ in range(min(max_tokens, rng.randint(20, 120))))
+
+    def tokens(self, text):
+        return re.findall(r'\s*\S+', text)
+
+    def completion_tokens(self, prompt, max_tokens):
+        return len(prompt) // 4 + max_tokens
+
+    def embedding_tokens(self, texts):
+        return sum(len(text) for text in texts) // 4 + 1
+
+    def embed(self, text):
+        digest = hashlib.blake2b(f'{self.seed}:{text}'.encode(), digest_size=8).digest()
+        vector = np.random.default_rng(int.from_bytes(digest, 'little')).standard_normal(self.dimension)
+        return normalize(vector).tolist()
+
+    def complete(self, prompt, max_tokens, temperature):
+        tokens = self.tokens(self.respond(prompt, max_tokens, temperature))
+        time.sleep(self.delay() + len(tokens) * self.token_delay())
+        self.fail()
+        return ''.join(tokens).strip()
+
+    def open_stream(self, prompt, max_tokens, temperature):
+        time.sleep(self.delay())
+        self.fail()
+        return self.tokens(self.respond(prompt, max_tokens, temperature))
+
+    def create(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        args = dict(prompt=prompt, max_tokens=max_tokens, temperature=temperature)
+        tokens = self.completion_tokens(prompt, max_tokens)
+        if stream:
+            return self.stream(self.call(self.completion_limiter, tokens, self.open_stream, **args))
+        return self.call(self.completion_limiter, tokens, self.complete, **args)
+
+    def stream(self, tokens):
+        for token in tokens:
+            time.sleep(self.token_delay())
+            yield token
+
+    async def acomplete(self, prompt, max_tokens, temperature):
+        tokens = self.tokens(self.respond(prompt, max_tokens, temperature))
+        await asyncio.sleep(self.delay() + len(tokens) * self.token_delay())
+        self.fail()
+        return ''.join(tokens).strip()
+
+    async def aopen_stream(self, prompt, max_tokens, temperature):
+        await asyncio.sleep(self.delay())
+        self.fail()
+        return self.tokens(self.respond(prompt, max_tokens, temperature))
+
+    async def acreate(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        args = dict(prompt=prompt, max_tokens=max_tokens, temperature=temperature)
+        tokens = self.completion_tokens(prompt, max_tokens)
+        if stream:
+            return self.astream(await self.acall(self.completion_limiter, tokens, self.aopen_stream, **args))
+        return await self.acall(self.completion_limiter, tokens, self.acomplete, **args)
+
+    async def astream(self, tokens):
+        for token in tokens:
+            await asyncio.sleep(self.token_delay())
+            yield token
+
+    def embed_batch(self, texts):
+        time.sleep(self.delay())
+        self.fail()
+        return [self.embed(text) for text in texts]
+
+    async def aembed_batch(self, texts):
+        await asyncio.sleep(self.delay())
+        self.fail()
+        return [self.embed(text) for text in texts]
+
+    def get_ada_embeddings(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.embedding_batch_size):
+            batch = texts[i : i + self.embedding_batch_size]
+            embeddings += self.call(self.embedding_limiter, self.embedding_tokens(batch), self.embed_batch, texts=batch)
+        return embeddings
+
+    async def aget_ada_embeddings(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.embedding_batch_size):
+            batch = texts[i : i + self.embedding_batch_size]
+            embeddings += await self.acall(
+                self.embedding_limiter, self.embedding_tokens(batch), self.aembed_batch, texts=batch
+            )
+        return embeddings
+
+
+class EvictionPolicy:
+    def __init__(self, kind='lru', max_entries=None, max_bytes=None, ttl=None):
+        self.kind = kind
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+
+class SqliteCache:
+    def __init__(self, cache_file, policies=None, compact_ratio=0.25):
+        self.cache_file = cache_file
+        self.policies = policies or {}
+        self.counters = {}
+        self.accesses = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS leases (partition TEXT, key BLOB, expires REAL, PRIMARY KEY (partition, key))'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (partition TEXT, key BLOB, value BLOB, nbytes INTEGER DEFAULT 0, '
+            'created REAL DEFAULT 0, accessed REAL DEFAULT 0, hits INTEGER DEFAULT 0, PRIMARY KEY (partition, key))'
+        )
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(cache)')}
+        for column, kind in [('nbytes', 'INTEGER'), ('created', 'REAL'), ('accessed', 'REAL'), ('hits', 'INTEGER')]:
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE cache ADD COLUMN {column} {kind} DEFAULT 0')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < 1:
+            # Rows are sized by key and value; the key holds the whole prompt for completions.
+            self.connection.execute('UPDATE cache SET nbytes = length(key) + length(value)')
+            self.connection.execute('PRAGMA user_version = 1')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (partition, accessed)')
+        self.connection.commit()
+        free_pages = self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+        total_pages = self.connection.execute('PRAGMA page_count').fetchone()[0]
+        if total_pages > 0 and free_pages / total_pages > compact_ratio:
+            self.compact()
+
+    def counter(self, partition):
+        return self.counters.setdefault(partition, {'hits': 0, 'misses': 0, 'evictions': 0})
+
+    def get(self, partition, key, count=True):
+        policy = self.policies.get(partition)
+        key = pickle.dumps(key, protocol=4)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, created FROM cache WHERE partition = ? AND key = ?', (partition, key)
+            ).fetchone()
+            if row is not None and policy is not None and policy.ttl is not None and row[1] + policy.ttl < time.time():
+                self.connection.execute('DELETE FROM cache WHERE partition = ? AND key = ?', (partition, key))
+                self.connection.commit()
+                self.counter(partition)['evictions'] += 1
+                row = None
+            if row is None:
+                self.counter(partition)['misses'] += count
+                return None
+            self.counter(partition)['hits'] += count
+            if policy is not None:
+                hits = self.accesses.get((partition, key), (0, 0))[1]
+                self.accesses[(partition, key)] = (time.time(), hits + 1)
+        return pickle.loads(row[0])
 
-    def create(self, prompt, max_tokens=100, temperature=0.5):
-        return (
-            openai.Completion.create(
-                engine='text-davinci-003',
-                prompt=prompt,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0,
+    def put(self, partition, key, value):
+        self.put_many(partition, [(key, value)], replace=True)
+
+    def put_many(self, partition, items, replace=False):
+        now = time.time()
+        rows = []
+        for key, value in items:
+            key, value = pickle.dumps(key, protocol=4), pickle.dumps(value, protocol=4)
+            rows.append((partition, key, value, len(key) + len(value), now, now, 1))
+        with self.lock:
+            self.connection.executemany(
+                f'INSERT OR {"REPLACE" if replace else "IGNORE"} INTO cache VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            self.evict(partition)
+            self.connection.commit()
+
+    def try_lease(self, partition, key, ttl):
+        key = pickle.dumps(key, protocol=4)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM leases WHERE partition = ? AND key = ? AND expires < ?', (partition, key, now)
             )
-            .choices[0]
-            .text.strip()
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO leases VALUES (?, ?, ?)', (partition, key, now + ttl)
+            )
+            self.connection.commit()
+        return now + ttl if cursor.rowcount == 1 else None
+
+    def release(self, leases):
+        with self.lock:
+            self.connection.executemany(
+                'DELETE FROM leases WHERE partition = ? AND key = ? AND expires = ?',
+                [(partition, pickle.dumps(key, protocol=4), expires) for partition, key, expires in leases],
+            )
+            self.connection.commit()
+
+    def flush_accesses(self):
+        rows = [(accessed, hits, partition, key) for (partition, key), (accessed, hits) in self.accesses.items()]
+        self.connection.executemany(
+            'UPDATE cache SET accessed = ?, hits = hits + ? WHERE partition = ? AND key = ?', rows
         )
+        self.accesses = {}
+
+    def evict(self, partition):
+        policy = self.policies.get(partition)
+        if policy is None:
+            return
+        self.flush_accesses()
+        if policy.ttl is not None:
+            cursor = self.connection.execute(
+                'DELETE FROM cache WHERE partition = ? AND created < ?', (partition, time.time() - policy.ttl)
+            )
+            self.counter(partition)['evictions'] += cursor.rowcount
+        entries, size = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM cache WHERE partition = ?', (partition,)
+        ).fetchone()
+        excess = entries - policy.max_entries if policy.max_entries is not None else 0
+        order = 'hits, accessed' if policy.kind == 'lfu' else 'accessed'
+        victims = []
+        if excess > 0 or (policy.max_bytes is not None and size > policy.max_bytes):
+            for key, nbytes in self.connection.execute(
+                f'SELECT key, nbytes FROM cache WHERE partition = ? ORDER BY {order}', (partition,)
+            ).fetchall():
+                if excess <= 0 and (policy.max_bytes is None or size <= policy.max_bytes):
+                    break
+                victims.append((partition, key))
+                excess -= 1
+                size -= nbytes
+        self.connection.executemany('DELETE FROM cache WHERE partition = ? AND key = ?', victims)
+        self.counter(partition)['evictions'] += len(victims)
+
+    def stats(self, partition):
+        with self.lock:
+            entries, size = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM cache WHERE partition = ?', (partition,)
+            ).fetchone()
+        return {**self.counter(partition), 'entries': entries, 'bytes': size}
+
+    def compact(self):
+        def vacuum():
+            connection = sqlite3.connect(self.cache_file, timeout=30)
+            try:
+                connection.execute('VACUUM')
+            except sqlite3.OperationalError:
+                pass
+            connection.close()
+
+        thread = threading.Thread(target=vacuum, daemon=True)
+        thread.start()
+        return thread
+
+
+INDEX_RECORD = np.dtype([('digest', '<u8'), ('created', '<f8')])
+
+
+class EmbeddingStore:
+    def __init__(self, embedding_file, dimension, capacity=1024, policy=None):
+        self.embedding_file = embedding_file
+        self.index_file = embedding_file + '.idx'
+        self.dimension = dimension
+        self.policy = policy
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.lock = threading.RLock()
+        self.lock_file = open(embedding_file + '.lock', 'a')
+        self.lock_depth = 0
+        if not os.path.isfile(self.index_file):
+            open(self.index_file, 'wb').close()
+        self.index_reader = open(self.index_file, 'rb', buffering=0)
+        self.version = None
+        self.rows = {}
+        self.free = []
+        self.size = 0
+        self.matrix = None
+        self.digests = np.zeros(0, dtype=np.uint64)
+        self.created = np.zeros(0)
+        self.accessed = np.zeros(0)
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.map(capacity)
+        self.refresh()
+
+    @contextlib.contextmanager
+    def locked(self, shared=False):
+        with self.lock:
+            if self.lock_depth == 0 and fcntl is not None:
+                fcntl.flock(self.lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def map(self, capacity):
+        with open(self.embedding_file, 'ab') as f:
+            if f.tell() < capacity * self.dimension * 4:
+                f.truncate(capacity * self.dimension * 4)
+        self.matrix = np.memmap(self.embedding_file, dtype=np.float32, mode='r+', shape=(capacity, self.dimension))
+        self.digests, self.created, self.accessed, self.hits = [
+            np.concatenate([values, np.zeros(capacity - len(values), dtype=values.dtype)])
+            for values in (self.digests, self.created, self.accessed, self.hits)
+        ]
+
+    def refresh(self):
+        with self.locked(shared=True):
+            stat = os.stat(self.index_file)
+            if self.version == (stat.st_size, stat.st_mtime_ns):
+                return
+            records = np.fromfile(self.index_file, dtype=INDEX_RECORD)
+            if len(records) > len(self.matrix):
+                self.map(max(2 * len(self.matrix), len(records)))
+            unchanged = self.digests[: len(records)] == records['digest']
+            self.accessed[: len(records)] = np.where(unchanged, self.accessed[: len(records)], records['created'])
+            self.hits[: len(records)] = np.where(unchanged, self.hits[: len(records)], 0)
+            self.digests[: len(records)] = records['digest']
+            self.created[: len(records)] = records['created']
+            live = np.flatnonzero(records['digest'] != 0)
+            self.rows = dict(zip(records['digest'][live].tolist(), live.tolist()))
+            self.free = np.flatnonzero(records['digest'] == 0).tolist()
+            self.size = len(records)
+            self.version = (stat.st_size, stat.st_mtime_ns)
+
+    def digest(self, text):
+        return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+    def stored_digest(self, row):
+        self.index_reader.seek(row * INDEX_RECORD.itemsize)
+        return int.from_bytes(self.index_reader.read(8) or bytes(8), 'little')
+
+    def expired(self, row, now):
+        return self.policy is not None and self.policy.ttl is not None and self.created[row] + self.policy.ttl < now
+
+    def get(self, text, count=True):
+        digest = self.digest(text)
+        if digest not in self.rows:
+            self.refresh()
+        now = time.time()
+        with self.locked(shared=True):
+            row = self.rows.get(digest)
+            if row is not None and self.stored_digest(row) != digest:
+                self.version = None
+                self.refresh()
+                row = self.rows.get(digest)
+            expired = row is not None and self.expired(row, now)
+            vector = None if row is None or expired else self.matrix[row].tolist()
+        if expired:
+            with self.locked():
+                self.refresh()
+                row = self.rows.get(digest)
+                if row is not None and self.expired(row, now):
+                    self.evict([row])
+        with self.lock:
+            if vector is None:
+                self.counters['misses'] += count
+                return None
+            self.counters['hits'] += count
+            self.accessed[row] = now
+            self.hits[row] += 1
+            return vector
+
+    def put(self, text, vector):
+        self.put_many([(text, vector)])
+
+    def allocate(self):
+        if len(self.free) > 0:
+            return self.free.pop()
+        if self.size == len(self.matrix):
+            self.map(2 * len(self.matrix))
+        self.size += 1
+        return self.size - 1
+
+    def put_many(self, items):
+        with self.locked():
+            self.refresh()
+            now = time.time()
+            rows = []
+            for text, vector in items:
+                digest = self.digest(text)
+                row = self.rows.get(digest)
+                if row is None:
+                    row = self.allocate()
+                self.matrix[row] = vector
+                self.rows[digest] = row
+                self.digests[row] = digest
+                self.created[row] = now
+                self.accessed[row] = now
+                self.hits[row] = 1
+                rows.append(row)
+            self.matrix.flush()
+            self.write_records(rows)
+            self.enforce()
+
+    def write_records(self, rows):
+        with open(self.index_file, 'r+b') as f:
+            for row in rows:
+                f.seek(row * INDEX_RECORD.itemsize)
+                f.write(np.array([(self.digests[row], self.created[row])], dtype=INDEX_RECORD).tobytes())
+        stat = os.stat(self.index_file)
+        self.version = (stat.st_size, stat.st_mtime_ns)
+
+    def evict(self, rows):
+        for row in rows:
+            del self.rows[int(self.digests[row])]
+            self.digests[row] = 0
+            self.created[row] = 0
+            self.free.append(row)
+        self.write_records(rows)
+        self.counters['evictions'] += len(rows)
+
+    def enforce(self):
+        if self.policy is None:
+            return
+        live = np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+        if self.policy.ttl is not None:
+            expired = self.created[live] + self.policy.ttl < time.time()
+            self.evict(live[expired].tolist())
+            live = live[~expired]
+        max_rows = len(live)
+        if self.policy.max_entries is not None:
+            max_rows = min(max_rows, self.policy.max_entries)
+        if self.policy.max_bytes is not None:
+            max_rows = min(max_rows, self.policy.max_bytes // (self.dimension * 4))
+        if len(live) > max_rows:
+            keys = (self.accessed[live], self.hits[live]) if self.policy.kind == 'lfu' else (self.accessed[live],)
+            self.evict(live[np.lexsort(keys)[: len(live) - max_rows]].tolist())
+
+    def stats(self):
+        return {**self.counters, 'entries': len(self.rows), 'bytes': len(self.rows) * self.dimension * 4}
 
 
 class TestAIService:
-    def __init__(self, ai_service, cache_file):
+    def __init__(
+        self,
+        ai_service,
+        cache_file,
+        embedding_file,
+        dimension,
+        legacy_cache_file=None,
+        create_policy=None,
+        ada_policy=None,
+        lease_ttl=120,
+        poll_interval=0.05,
+    ):
         self.ai_service = ai_service
-        self.cache_file = cache_file
-        if os.path.isfile(cache_file):
-            self.cache = pickle.load(open(cache_file, 'rb'))
-        else:
-            self.cache = {'ada': {}, 'create': {}}
-            pickle.dump(self.cache, open(cache_file, 'wb'))
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        is_new = not os.path.isfile(cache_file)
+        self.cache = SqliteCache(cache_file, policies={'create': create_policy} if create_policy is not None else None)
+        self.embeddings = EmbeddingStore(embedding_file, dimension, policy=ada_policy)
+        if is_new and legacy_cache_file is not None and os.path.isfile(legacy_cache_file):
+            legacy_cache = pickle.load(open(legacy_cache_file, 'rb'))
+            self.cache.put_many('create', legacy_cache['create'].items())
+            self.embeddings.put_many(list(legacy_cache['ada'].items()))
+
+    def stats(self):
+        return {'create': self.cache.stats('create'), 'ada': self.embeddings.stats()}
+
+    async def aclose(self):
+        if hasattr(self.ai_service, 'aclose'):
+            await self.ai_service.aclose()
+
+    def sorted_keys(self, keys):
+        return sorted(keys, key=lambda key: (key[0], pickle.dumps(key[1], protocol=4)))
+
+    @contextlib.contextmanager
+    def lease(self, keys):
+        acquired = []
+        try:
+            for partition, key in self.sorted_keys(keys):
+                expires = self.cache.try_lease(partition, key, self.lease_ttl)
+                while expires is None:
+                    time.sleep(self.poll_interval)
+                    expires = self.cache.try_lease(partition, key, self.lease_ttl)
+                acquired.append((partition, key, expires))
+            yield
+        finally:
+            self.cache.release(acquired)
+
+    async def offload(self, function, *args, **kwargs):
+        # Cache and lease calls wait on sqlite's busy timeout and on flock; keep them off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    def get_embeddings(self, texts, count=True):
+        return [self.embeddings.get(text, count=count) for text in texts]
+
+    @contextlib.asynccontextmanager
+    async def alease(self, keys):
+        acquired = []
+        try:
+            for partition, key in self.sorted_keys(keys):
+                expires = await self.offload(self.cache.try_lease, partition, key, self.lease_ttl)
+                while expires is None:
+                    await asyncio.sleep(self.poll_interval)
+                    expires = await self.offload(self.cache.try_lease, partition, key, self.lease_ttl)
+                acquired.append((partition, key, expires))
+            yield
+        finally:
+            await self.offload(self.cache.release, acquired)
 
     def get_ada_embedding(self, text):
-        if text not in self.cache['ada']:
-            self.cache['ada'][text] = self.ai_service.get_ada_embedding(text)
-            pickle.dump(self.cache, open(self.cache_file, 'wb'))
-        return self.cache['ada'][text]
+        return self.get_ada_embeddings([text])[0]
 
-    def create(self, prompt, max_tokens=100, temperature=0.5):
+    def get_ada_embeddings(self, texts):
+        embeddings = self.get_embeddings(texts)
+        misses = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        if len(misses) == 0:
+            return embeddings
+        with self.lease([('ada', text) for text in misses]):
+            fetched = dict(zip(misses, self.get_embeddings(misses, count=False)))
+            misses = [text for text, embedding in fetched.items() if embedding is None]
+            if len(misses) > 0:
+                fetched.update(zip(misses, self.ai_service.get_ada_embeddings(misses)))
+                self.embeddings.put_many([(text, fetched[text]) for text in misses])
+        return [fetched[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+    async def aget_ada_embedding(self, text):
+        return (await self.aget_ada_embeddings([text]))[0]
+
+    async def aget_ada_embeddings(self, texts):
+        embeddings = await self.offload(self.get_embeddings, texts)
+        misses = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        if len(misses) == 0:
+            return embeddings
+        async with self.alease([('ada', text) for text in misses]):
+            fetched = dict(zip(misses, await self.offload(self.get_embeddings, misses, count=False)))
+            misses = [text for text, embedding in fetched.items() if embedding is None]
+            if len(misses) > 0:
+                fetched.update(zip(misses, await self.ai_service.aget_ada_embeddings(misses)))
+                await self.offload(self.embeddings.put_many, [(text, fetched[text]) for text in misses])
+        return [fetched[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+    def create(self, prompt, max_tokens=100, temperature=0.5, stream=False):
         key = (prompt, max_tokens, temperature)
-        if key not in self.cache['create']:
-            self.cache['create'][key] = self.ai_service.create(prompt, max_tokens, temperature)
-            pickle.dump(self.cache, open(self.cache_file, 'wb'))
-        return self.cache['create'][key]
+        response = self.cache.get('create', key)
+        if stream:
+            return self.replay(response) if response is not None else self.record(key)
+        if response is None:
+            with self.lease([('create', key)]):
+                response = self.cache.get('create', key, count=False)
+                if response is None:
+                    response = self.ai_service.create(prompt, max_tokens, temperature)
+                    self.cache.put('create', key, response)
+        return response
+
+    def replay(self, response):
+        yield from re.findall(r'\s*\S+', response)
+
+    def record(self, key):
+        with self.lease([('create', key)]):
+            response = self.cache.get('create', key, count=False)
+            if response is not None:
+                yield from self.replay(response)
+                return
+            chunks = []
+            for token in self.ai_service.create(*key, stream=True):
+                chunks.append(token)
+                yield token
+            self.cache.put('create', key, ''.join(chunks).strip())
+
+    async def acreate(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        key = (prompt, max_tokens, temperature)
+        response = await self.offload(self.cache.get, 'create', key)
+        if stream:
+            return self.areplay(response) if response is not None else self.arecord(key)
+        if response is None:
+            async with self.alease([('create', key)]):
+                response = await self.offload(self.cache.get, 'create', key, count=False)
+                if response is None:
+                    response = await self.ai_service.acreate(prompt, max_tokens, temperature)
+                    await self.offload(self.cache.put, 'create', key, response)
+        return response
+
+    async def areplay(self, response):
+        for token in re.findall(r'\s*\S+', response):
+            yield token
+
+    async def arecord(self, key):
+        async with self.alease([('create', key)]):
+            response = await self.offload(self.cache.get, 'create', key, count=False)
+            if response is not None:
+                async for token in self.areplay(response):
+                    yield token
+                return
+            chunks = []
+            async for token in await self.ai_service.acreate(*key, stream=True):
+                chunks.append(token)
+                yield token
+            await self.offload(self.cache.put, 'create', key, ''.join(chunks).strip())
+
+
+def task_list_pattern(template, field):
+    before, after = template.split('{' + field + '}')
+    before = before.rsplit('}', 1)[-1].rsplit('\n', 1)[-1]
+    return re.compile(f'({re.escape(before)})(.*?)({re.escape(after.split("{", 1)[0])})', re.S)
+
+
+TASK_LIST_PATTERNS = (
+    task_list_pattern(TASK_CREATION_PROMPT, 'task_list'),
+    task_list_pattern(PRIORITIZATION_PROMPT, 'task_names'),
+)
+
+
+def normalize_prompt(prompt):
+    for pattern in TASK_LIST_PATTERNS:
+        prompt = pattern.sub(lambda m: m.group(1) + ', '.join(sorted(m.group(2).split(', '))) + m.group(3), prompt)
+    return prompt
+
+
+class SemanticAIService:
+    def __init__(self, ai_service, threshold=0.97, dimension=1536, semantic_templates=(EXECUTION_PROMPT,)):
+        self.ai_service = ai_service
+        self.threshold = threshold
+        self.dimension = dimension
+        self.semantic_prefixes = tuple(template.split('{', 1)[0] for template in semantic_templates)
+        self.responses = {}
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+
+    def stats(self):
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        stats = self.ai_service.stats() if hasattr(self.ai_service, 'stats') else {}
+        stats['semantic'] = {
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups > 0 else 0.0,
+            'seconds_saved': hits * self.miss_seconds / self.misses if self.misses > 0 else 0.0,
+        }
+        return stats
+
+    async def aclose(self):
+        if hasattr(self.ai_service, 'aclose'):
+            await self.ai_service.aclose()
+
+    def get_ada_embedding(self, text):
+        return self.ai_service.get_ada_embedding(text)
+
+    def get_ada_embeddings(self, texts):
+        return self.ai_service.get_ada_embeddings(texts)
+
+    async def aget_ada_embedding(self, text):
+        return await self.ai_service.aget_ada_embedding(text)
+
+    async def aget_ada_embeddings(self, texts):
+        return await self.ai_service.aget_ada_embeddings(texts)
+
+    def exact_match(self, prompt, max_tokens, temperature):
+        with self.lock:
+            response = self.responses.get((normalize_prompt(prompt), max_tokens, temperature))
+            if response is not None:
+                self.exact_hits += 1
+            return response
+
+    def semantic_prefix(self, prompt):
+        return next((prefix for prefix in self.semantic_prefixes if prompt.startswith(prefix)), None)
+
+    def semantic_match(self, prefix, vector, max_tokens, temperature):
+        with self.lock:
+            index = self.indexes.get((prefix, max_tokens, temperature))
+            matches = [] if index is None else index.query(vector, 1, columns=TASK_COLUMNS + ('vector',))
+            if len(matches) == 0 or float(normalize(matches[0].vector) @ vector) < self.threshold:
+                return None
+            self.semantic_hits += 1
+            return matches[0].result
+
+    def store(self, prompt, max_tokens, temperature, vector, response, seconds):
+        with self.lock:
+            self.responses[(normalize_prompt(prompt), max_tokens, temperature)] = response
+            if vector is not None:
+                key = (self.semantic_prefix(prompt), max_tokens, temperature)
+                index = self.indexes.setdefault(key, NumpyService(self.dimension))
+                index.upsert(Task(name=prompt, id=len(index.tasks), result=response, vector=vector))
+            self.misses += 1
+            self.miss_seconds += seconds
+
+    def replay(self, response):
+        yield from re.findall(r'\s*\S+', response)
+
+    def record(self, prompt, max_tokens, temperature, vector, tokens):
+        start = time.perf_counter()
+        chunks = []
+        for token in tokens:
+            chunks.append(token)
+            yield token
+        self.store(prompt, max_tokens, temperature, vector, ''.join(chunks).strip(), time.perf_counter() - start)
+
+    def create(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        response = self.exact_match(prompt, max_tokens, temperature)
+        vector = None
+        prefix = self.semantic_prefix(prompt)
+        if response is None and prefix is not None:
+            vector = normalize(self.ai_service.get_ada_embedding(prompt))
+            response = self.semantic_match(prefix, vector, max_tokens, temperature)
+        if response is not None:
+            return self.replay(response) if stream else response
+        if stream:
+            return self.record(
+                prompt, max_tokens, temperature, vector, self.ai_service.create(prompt, max_tokens, temperature, True)
+            )
+        start = time.perf_counter()
+        response = self.ai_service.create(prompt, max_tokens, temperature)
+        self.store(prompt, max_tokens, temperature, vector, response, time.perf_counter() - start)
+        return response
+
+    async def areplay(self, response):
+        for token in re.findall(r'\s*\S+', response):
+            yield token
+
+    async def arecord(self, prompt, max_tokens, temperature, vector, tokens):
+        start = time.perf_counter()
+        chunks = []
+        async for token in tokens:
+            chunks.append(token)
+            yield token
+        self.store(prompt, max_tokens, temperature, vector, ''.join(chunks).strip(), time.perf_counter() - start)
+
+    async def acreate(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        response = self.exact_match(prompt, max_tokens, temperature)
+        vector = None
+        prefix = self.semantic_prefix(prompt)
+        if response is None and prefix is not None:
+            vector = normalize(await self.ai_service.aget_ada_embedding(prompt))
+            response = self.semantic_match(prefix, vector, max_tokens, temperature)
+        if response is not None:
+            return self.areplay(response) if stream else response
+        if stream:
+            tokens = await self.ai_service.acreate(prompt, max_tokens, temperature, True)
+            return self.arecord(prompt, max_tokens, temperature, vector, tokens)
+        start = time.perf_counter()
+        response = await self.ai_service.acreate(prompt, max_tokens, temperature)
+        self.store(prompt, max_tokens, temperature, vector, response, time.perf_counter() - start)
+        return response
 
 
 class PineconeService:
@@ -94,108 +1132,1012 @@ class PineconeService:
             pinecone.create_index(table_name, dimension=dimension, metric=metric, pod_type=pod_type)
         self.index = pinecone.Index(table_name)
 
-    def query(self, query_embedding, top_k):
-        results = self.index.query(query_embedding, top_k=top_k, include_metadata=True)
+    def query(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        results = self.index.query(
+            query_embedding, top_k=top_k, include_metadata=True, include_values='vector' in columns
+        )
         sorted_results = sorted(results.matches, key=lambda x: x.score, reverse=True)
-        return [Task(**item.metadata) for item in sorted_results]
+        return [
+            Task(**{c: item.values if c == 'vector' else item.metadata[c] for c in columns}) for item in sorted_results
+        ]
 
     def upsert(self, task):
-        self.index.upsert([(task.id, task.vector, task.__dict__)])
+        self.upsert_many([task])
+
+    def upsert_many(self, tasks):
+        self.index.upsert([(task.id, task.vector.tolist(), task.metadata()) for task in tasks], batch_size=100)
+
+    async def aquery(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        return await asyncio.get_running_loop().run_in_executor(None, self.query, query_embedding, top_k, columns)
+
+    async def aupsert(self, task):
+        await self.aupsert_many([task])
+
+    async def aupsert_many(self, tasks):
+        await asyncio.get_running_loop().run_in_executor(None, self.upsert_many, tasks)
 
 
 class LanceService:
-    def __init__(self, table_name, dimension):
-        self.db = lancedb.connect('.')
-        schema = pa.schema(
+    def __init__(
+        self,
+        table_name,
+        dimension,
+        mode='overwrite',
+        index_threshold=10000,
+        reindex_ratio=0.5,
+        num_partitions=None,
+        num_sub_vectors=96,
+        nprobes=20,
+        refine_factor=None,
+        uri='.',
+    ):
+        self.db = lancedb.connect(uri)
+        self.dataset_uri = os.path.join(uri, f'{table_name}.lance')
+        self.index_threshold = index_threshold
+        self.reindex_ratio = reindex_ratio
+        self.num_partitions = num_partitions
+        self.num_sub_vectors = num_sub_vectors
+        self.nprobes = nprobes
+        self.refine_factor = refine_factor
+        self.indexed_rows = 0
+        self.schema = pa.schema(
             [
                 pa.field('id', pa.int32()),
                 pa.field('vector', pa.list_(pa.float32(), dimension)),
                 pa.field('name', pa.string()),
-                pa.field('result', pa.string()),  # TODO There is a fixed schema but we keep converting
+                pa.field('result', pa.string()),
             ]
         )
-        data = [{'id': 0, 'vector': [0.0] * dimension, 'name': 'asd', 'result': 'asd'}]
-        self.table = self.db.create_table(table_name, mode='overwrite', data=data, schema=schema)
+        if mode == 'open' and table_name in self.db.table_names():
+            self.table = self.db.open_table(table_name)
+            self.indexed_rows = self.existing_index_rows()
+        else:
+            data = pa.Table.from_pylist([], schema=self.schema)
+            self.table = self.db.create_table(table_name, mode='overwrite', data=data, schema=self.schema)
 
-    def query(self, query_embedding, top_k):
-        result = self.table.search(query_embedding).limit(top_k).to_df().drop(columns=['score'])
-        return [Task(**v) for v in result.to_dict(orient="records")]
+    def query(self, query_embedding, top_k, columns=TASK_COLUMNS, nprobes=None, refine_factor=None):
+        query = self.table.search(query_embedding).limit(top_k).select(list(columns))
+        if self.indexed_rows > 0:
+            query = query.nprobes(nprobes or self.nprobes)
+            if (refine_factor or self.refine_factor) is not None:
+                query = query.refine_factor(refine_factor or self.refine_factor)
+        return tasks_from_arrow(query.to_arrow(), columns)
+
+    def existing_index_rows(self):
+        if len(lance.dataset(self.dataset_uri).list_indices()) == 0:
+            return 0
+        return len(self.table)
+
+    def update_index(self):
+        # Runs inside upsert_many and blocks it (and, behind BufferedVectorService, every query) for a full
+        # IVF-PQ build. reindex_ratio keeps rebuilds to one per geometric growth step of the table.
+        rows = len(self.table)
+        if rows < self.index_threshold or rows < self.indexed_rows * (1 + self.reindex_ratio):
+            return
+        self.table.create_index(
+            metric='L2',
+            num_partitions=self.num_partitions or int(rows**0.5),
+            num_sub_vectors=self.num_sub_vectors,
+        )
+        self.indexed_rows = rows
+
+    def load_tasks(self, columns=TASK_COLUMNS):
+        return tasks_from_arrow(self.table.to_arrow().select(list(columns)), columns)
 
     def upsert(self, task):
-        self.table.add(pd.DataFrame([task.__dict__]))
+        self.upsert_many([task])
+
+    def upsert_many(self, tasks):
+        vectors = np.stack([task.vector for task in tasks])
+        data = {c: [getattr(task, c) for task in tasks] for c in TASK_COLUMNS}
+        data['vector'] = pa.FixedSizeListArray.from_arrays(vectors.ravel(), vectors.shape[1])
+        self.table.add(pa.Table.from_pydict(data, schema=self.schema))
+        self.update_index()
+
+    async def aquery(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        return await asyncio.get_running_loop().run_in_executor(None, self.query, query_embedding, top_k, columns)
+
+    async def aupsert(self, task):
+        await self.aupsert_many([task])
+
+    async def aupsert_many(self, tasks):
+        await asyncio.get_running_loop().run_in_executor(None, self.upsert_many, tasks)
+
+
+class NumpyService:
+    def __init__(self, dimension, capacity=1024):
+        self.vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self.tasks = []
+        self.rows = {}
+
+    def query(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        top_k = min(top_k, len(self.tasks))
+        if top_k == 0:
+            return []
+        scores = self.vectors[: len(self.tasks)] @ np.asarray(query_embedding, dtype=np.float32)
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        return [self.project(self.tasks[i], columns) for i in top[np.argsort(-scores[top])]]
+
+    def load_tasks(self, columns=TASK_COLUMNS):
+        return [self.project(task, columns) for task in self.tasks]
+
+    def project(self, task, columns):
+        return Task(**{c: getattr(task, c) for c in columns})
+
+    def upsert(self, task):
+        if task.id not in self.rows:
+            if len(self.tasks) == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.rows[task.id] = len(self.tasks)
+            self.tasks.append(task)
+        self.vectors[self.rows[task.id]] = task.vector
+        self.tasks[self.rows[task.id]] = task
+
+    def upsert_many(self, tasks):
+        for task in tasks:
+            self.upsert(task)
+
+    async def aquery(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        return self.query(query_embedding, top_k, columns)
+
+    async def aupsert(self, task):
+        self.upsert(task)
+
+    async def aupsert_many(self, tasks):
+        self.upsert_many(tasks)
+
+
+class BufferedVectorService:
+    def __init__(self, vector_service, max_size=100, max_delay=5.0):
+        self.vector_service = vector_service
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.buffer = []
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def buffer_tasks(self, tasks):
+        with self.lock:
+            self.buffer += tasks
+            if len(self.buffer) < self.max_size and self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            return len(self.buffer) >= self.max_size
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            tasks, self.buffer = self.buffer, []
+            if len(tasks) > 0:
+                self.vector_service.upsert_many(tasks)
+
+    def close(self):
+        self.flush()
+
+    def query(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        with self.lock:
+            self.flush()
+            return self.vector_service.query(query_embedding, top_k, columns)
+
+    def load_tasks(self, columns=TASK_COLUMNS):
+        with self.lock:
+            self.flush()
+            return self.vector_service.load_tasks(columns)
+
+    def upsert(self, task):
+        self.upsert_many([task])
+
+    def upsert_many(self, tasks):
+        if self.buffer_tasks(tasks):
+            self.flush()
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def aquery(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        return await asyncio.get_running_loop().run_in_executor(None, self.query, query_embedding, top_k, columns)
+
+    async def aupsert(self, task):
+        await self.aupsert_many([task])
+
+    async def aupsert_many(self, tasks):
+        await asyncio.get_running_loop().run_in_executor(None, self.upsert_many, tasks)
+
+
+class TaskQueue:
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.next_id = 1
+        self.completed_ids = set()
+        self.low = 0
+        self.high = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, task_id):
+        return task_id in self.entries
+
+    def __iter__(self):
+        return (entry[2] for entry in sorted(self.entries.values()))
+
+    def get(self, task_id):
+        return self.entries[task_id][2]
+
+    def top(self, n):
+        return [entry[2] for entry in heapq.nsmallest(n, self.entries.values())]
+
+    def push(self, task, priority=None):
+        if (
+            task.id is None
+            or task.id in self.completed_ids
+            or (task.id in self.entries and self.entries[task.id][2] is not task)
+        ):
+            task.id = self.next_id
+        self.next_id = max(self.next_id, task.id + 1)
+        if task.id in self.entries:
+            self.remove(task.id)
+        if priority is None:
+            priority = self.high + 1
+        self.low = min(self.low, priority)
+        self.high = max(self.high, priority)
+        entry = [priority, next(self.sequence), task]
+        self.entries[task.id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def prepend(self, tasks):
+        low = self.low
+        for i, task in enumerate(tasks):
+            self.push(task, priority=low - len(tasks) + i)
+
+    def reprioritize(self, task_id, priority):
+        self.push(self.get(task_id), priority)
+
+    def remove(self, task_id):
+        self.entries.pop(task_id)[2] = None
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def pop(self):
+        while True:
+            task = heapq.heappop(self.heap)[2]
+            if task is not None:
+                del self.entries[task.id]
+                self.completed_ids.add(task.id)
+                return task
+
+    def clear(self):
+        self.heap = []
+        self.entries = {}
+
+
+@functools.lru_cache(maxsize=None)
+def token_encoding():
+    return tiktoken.get_encoding('p50k_base')
+
+
+def count_tokens(text):
+    if isinstance(text, (list, tuple)):
+        return sum(count_tokens(t) for t in text)
+    if tiktoken is None:
+        return len(text) // 4
+    return len(token_encoding().encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    if tiktoken is None:
+        return text[: max_tokens * 4].rsplit(' ', 1)[0] + ' ...'
+    return token_encoding().decode(token_encoding().encode(text)[:max_tokens]) + ' ...'
+
+
+class PromptBudget:
+    def __init__(
+        self, creation_tokens=1500, prioritization_tokens=1000, result_tokens=500, max_tasks=20, task_list_tokens=200
+    ):
+        self.creation_tokens = creation_tokens
+        self.prioritization_tokens = prioritization_tokens
+        self.result_tokens = result_tokens
+        self.max_tasks = max_tasks
+        self.task_list_tokens = task_list_tokens
+
+    def result_allowance(self, template_tokens):
+        # Results get what is left of the creation budget after the template, minus room for pending task names.
+        remaining = self.creation_tokens - template_tokens
+        return max(0, min(self.result_tokens, remaining - min(self.task_list_tokens, remaining // 2)))
+
+    def truncate_results(self, results, max_tokens):
+        max_tokens //= len(results)
+        return [truncate_tokens(result, max_tokens) if max_tokens > 0 else '' for result in results]
+
+    def task_tokens(self, task):
+        return count_tokens(task.name) + 1
+
+    def fits(self, tasks, max_tokens):
+        return len(tasks) <= self.max_tasks and sum(self.task_tokens(t) for t in tasks) <= max_tokens
+
+    def select(self, ranked_tasks, max_tokens):
+        selected = []
+        for task in ranked_tasks[: self.max_tasks]:
+            max_tokens -= self.task_tokens(task)
+            if max_tokens < 0:
+                break
+            selected.append(task)
+        return selected
+
+
+class NullStage:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class EventBus:
+    def __init__(self, subscribers=()):
+        self.subscribers = list(subscribers)
+        self.iteration = 0
+
+    @property
+    def enabled(self):
+        return len(self.subscribers) > 0
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+
+    def emit(self, event, **fields):
+        if 'prompt' in fields:
+            fields['prompt_tokens'] = count_tokens(fields.pop('prompt'))
+        if 'completion' in fields:
+            fields['completion_tokens'] = count_tokens(fields.pop('completion'))
+        fields = {'event': event, 'iteration': self.iteration, 'time': time.time(), **fields}
+        for subscriber in self.subscribers:
+            subscriber(fields)
+
+    def stage(self, event, **fields):
+        if not self.subscribers:
+            return NullStage()
+        return self.timed_stage(event, fields)
+
+    @contextlib.contextmanager
+    def timed_stage(self, event, fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.emit(event, seconds=time.perf_counter() - start, **fields)
+
+
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+
+class PrometheusExporter:
+    def __init__(self, path=None, prefix='babyagi'):
+        self.path = path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.seconds = {}
+        self.tokens = {}
+        self.executions_saved = 0
+        self.gauges = {}
+
+    def __call__(self, event):
+        stage = event['event']
+        with self.lock:
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + event['seconds']
+            for kind in ('prompt', 'completion'):
+                if f'{kind}_tokens' in event:
+                    self.tokens[stage, kind] = self.tokens.get((stage, kind), 0) + event[f'{kind}_tokens']
+            self.executions_saved += event.get('executions_saved', 0)
+            if 'queue_depth' in event:
+                self.gauges['queue_depth', ()] = event['queue_depth']
+            for stat, value in self.flatten(event.get('cache', {})):
+                self.gauges['cache', (('stat', stat),)] = value
+        if self.path is not None and stage == 'iteration':
+            self.write()
+
+    def flatten(self, stats, prefix=''):
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                yield from self.flatten(value, f'{prefix}{key}_')
+            else:
+                yield f'{prefix}{key}', value
+
+    def labels(self, pairs):
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+
+    def render(self):
+        p = self.prefix
+        with self.lock:
+            lines = [f'# TYPE {p}_stage_seconds summary']
+            for stage in sorted(self.counts):
+                lines.append(f'{p}_stage_seconds_sum{self.labels([("stage", stage)])} {self.seconds[stage]}')
+                lines.append(f'{p}_stage_seconds_count{self.labels([("stage", stage)])} {self.counts[stage]}')
+            lines.append(f'# TYPE {p}_tokens_total counter')
+            for (stage, kind), value in sorted(self.tokens.items()):
+                lines.append(f'{p}_tokens_total{self.labels([("stage", stage), ("kind", kind)])} {value}')
+            lines.append(f'# TYPE {p}_executions_saved_total counter')
+            lines.append(f'{p}_executions_saved_total {self.executions_saved}')
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f'# TYPE {p}_{name} gauge')
+                for (gauge, pairs), value in sorted(self.gauges.items()):
+                    if gauge == name:
+                        lines.append(f'{p}_{name}{self.labels(pairs)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        text = self.render()
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(self.path + '.tmp', self.path)
 
 
 class BabyAGI:
-    def __init__(self, objective, ai_service, vector_service):
+    def __init__(
+        self,
+        objective,
+        ai_service,
+        vector_service,
+        workers=1,
+        on_token=None,
+        prioritization_window=None,
+        dedup_threshold=None,
+        events=None,
+        prompt_budget=None,
+        retrieval_top_k=5,
+        context_tokens=500,
+        retrieval_cache_size=256,
+    ):
         self.ai_service = ai_service
         self.vector_service = vector_service
         self.objective = objective
         self.objective_embedding = self.ai_service.get_ada_embedding(self.objective)
-        self.task_list = deque([])
+        self.task_list = TaskQueue()
+        self.workers = workers
+        self.on_token = on_token
+        self.prioritization_window = prioritization_window
+        self.new_task_ids = set()
+        self.dedup_threshold = dedup_threshold
+        self.executions_saved = 0
+        self.name_vectors = {}
+        self.completed_names = None if dedup_threshold is None else NumpyService(len(self.objective_embedding))
+        self.events = events if events is not None else EventBus()
+        self.prompt_budget = prompt_budget
+        self.retrieval_top_k = retrieval_top_k
+        self.context_tokens = context_tokens
+        self.retrieval_cache_size = retrieval_cache_size
+        self.retrievals = {}
 
     def add_task(self, task):
-        if task.id is None:
-            task.id = max([t.id for t in self.task_list], default=0) + 1
-        self.task_list.append(task)
+        self.task_list.push(task)
+
+    def next_tasks(self):
+        return [self.task_list.pop() for _ in range(min(self.workers, len(self.task_list)))]
 
-    def task_creation_agent(self, task):
-        prompt = TASK_CREATION_PROMPT.format(
+    def format_task_creation_prompt(self, tasks, results, pending_tasks):
+        return TASK_CREATION_PROMPT.format(
             objective=self.objective,
-            result=task.result,
-            task_description=task.name,
-            task_list=', '.join([t.name for t in self.task_list]),
+            result='\n\n'.join(results),
+            task_description=', '.join([t.name for t in tasks]),
+            task_list=', '.join([t.name for t in pending_tasks]),
         )
-        for task_name in self.ai_service.create(prompt).split('\n'):
-            self.add_task(Task(name=task_name))
 
-    def task_prioritization_agent(self, this_task_id):
+    def creation_results(self, tasks):
+        results = [t.result for t in tasks]
+        if self.prompt_budget is None:
+            return results
+        max_tokens = self.prompt_budget.result_allowance(count_tokens(self.format_task_creation_prompt(tasks, [], [])))
+        truncated = self.prompt_budget.truncate_results(results, max_tokens)
+        while max_tokens > 0 and (
+            count_tokens(self.format_task_creation_prompt(tasks, truncated, [])) > self.prompt_budget.creation_tokens
+        ):
+            max_tokens //= 2
+            truncated = self.prompt_budget.truncate_results(results, max_tokens)
+        return truncated
+
+    def task_creation_prompt(self, tasks, pending_tasks=None):
+        return self.format_task_creation_prompt(
+            tasks, self.creation_results(tasks), self.task_list if pending_tasks is None else pending_tasks
+        )
+
+    def select_relevant(self, tasks, vectors, max_tokens):
+        scores = normalize(vectors) @ normalize(self.objective_embedding)
+        ranked_tasks = [tasks[i] for i in np.argsort(-scores, kind='stable')]
+        selected = {t.id for t in self.prompt_budget.select(ranked_tasks, max_tokens)}
+        return [t for t in tasks if t.id in selected]
+
+    def fit_tasks(self, tasks, build_prompt, max_tokens):
+        # Per-name counts are an estimate; drop trailing tasks until the joined prompt fits.
+        while len(tasks) > 0 and count_tokens(build_prompt(tasks)) > max_tokens:
+            tasks = tasks[:-1]
+        return tasks
+
+    def relevant_tasks(self, tasks, build_prompt, max_tokens):
+        task_tokens = max_tokens - count_tokens(build_prompt([]))
+        if not self.prompt_budget.fits(tasks, task_tokens):
+            vectors = self.ai_service.get_ada_embeddings([t.name for t in tasks])
+            tasks = self.select_relevant(tasks, vectors, task_tokens)
+        return self.fit_tasks(tasks, build_prompt, max_tokens)
+
+    def pending_tasks(self, tasks):
+        pending_tasks = list(self.task_list)
+        if self.prompt_budget is None:
+            return pending_tasks
+        results = self.creation_results(tasks)
+        return self.relevant_tasks(
+            pending_tasks,
+            lambda pending: self.format_task_creation_prompt(tasks, results, pending),
+            self.prompt_budget.creation_tokens,
+        )
+
+    def add_created_tasks(self, task_names):
+        for task_name in task_names:
+            if task_name.strip() == '':
+                continue
+            task = Task(name=task_name)
+            self.add_task(task)
+            self.new_task_ids.add(task.id)
+
+    def dedup_candidates(self, task_names):
+        return list(dict.fromkeys(name.strip() for name in task_names if name.strip() != ''))
+
+    def select_unique(self, task_names, candidates, vectors, completed):
+        candidate_vectors, pending_vectors = vectors[: len(candidates)], vectors[len(candidates) :]
+        kept = []
+        for i, vector in enumerate(candidate_vectors):
+            completed_vectors = normalize([t.vector for t in completed[i]]).reshape(-1, len(vector))
+            similarities = np.concatenate(
+                [pending_vectors @ vector, candidate_vectors[kept] @ vector, completed_vectors @ vector]
+            )
+            if len(similarities) == 0 or similarities.max() < self.dedup_threshold:
+                kept.append(i)
+        self.executions_saved += len([name for name in task_names if name.strip() != '']) - len(kept)
+        return [candidates[i] for i in kept]
+
+    def completed_matches(self, vectors):
+        return [self.completed_names.query(v, 1, columns=TASK_COLUMNS + ('vector',)) for v in vectors]
+
+    def remember_completed(self, tasks, name_vectors):
+        if len(name_vectors) > 0:
+            self.completed_names.upsert_many(
+                [Task(name=t.name, id=t.id, result=t.result, vector=v) for t, v in zip(tasks, normalize(name_vectors))]
+            )
+
+    def embedding_texts(self, tasks):
+        names = [] if self.completed_names is None else [t.name for t in tasks]
+        return [t.result for t in tasks] + names
+
+    def unembedded_names(self, candidates):
+        # Pending names keep their vectors between creation passes; only new names are embedded.
+        pending_names = [t.name for t in self.task_list]
+        self.name_vectors = {name: self.name_vectors[name] for name in pending_names if name in self.name_vectors}
+        return [name for name in dict.fromkeys(candidates + pending_names) if name not in self.name_vectors]
+
+    def dedup_vectors(self, candidates, names, vectors):
+        self.name_vectors.update(zip(names, normalize(vectors).reshape(len(names), -1)))
+        return np.stack([self.name_vectors[name] for name in candidates + [t.name for t in self.task_list]])
+
+    def deduplicate(self, task_names):
+        candidates = self.dedup_candidates(task_names)
+        if len(candidates) == 0:
+            return self.select_unique(task_names, [], np.zeros((0, 0)), [])
+        names = self.unembedded_names(candidates)
+        vectors = self.dedup_vectors(candidates, names, self.ai_service.get_ada_embeddings(names) if names else [])
+        completed = self.completed_matches(vectors[: len(candidates)])
+        return self.select_unique(task_names, candidates, vectors, completed)
+
+    def task_creation_agent(self, tasks):
+        prompt = self.task_creation_prompt(tasks, self.pending_tasks(tasks))
+        with self.events.stage('creation', prompt=prompt) as fields:
+            response = fields['completion'] = self.ai_service.create(prompt)
+            task_names = response.split('\n')
+            if self.dedup_threshold is not None:
+                executions_saved = self.executions_saved
+                task_names = self.deduplicate(task_names)
+                fields['executions_saved'] = self.executions_saved - executions_saved
+            self.add_created_tasks(task_names)
+
+    def prioritization_tasks(self):
+        if self.prioritization_window is None:
+            return list(self.task_list)
+        top_tasks = self.task_list.top(self.prioritization_window + len(self.new_task_ids))
+        old_tasks = [t for t in top_tasks if t.id not in self.new_task_ids][: self.prioritization_window]
+        return old_tasks + [self.task_list.get(i) for i in sorted(self.new_task_ids) if i in self.task_list]
+
+    def task_prioritization_prompt(self, this_task_id, tasks):
+        return PRIORITIZATION_PROMPT.format(
+            task_names=', '.join([t.name for t in tasks]),
+            objective=self.objective,
+            next_task_id=int(this_task_id) + 1,
+        )
+
+    def set_prioritized_tasks(self, response, tasks):
         def to_task(value):
             parts = value.strip().split('.', 1)
-            if len(parts) != 2:
+            if len(parts) != 2 or parts[1].strip() == '':
                 return None
             return Task(id=int(parts[0].strip()), name=parts[1].strip())
 
-        prompt = PRIORITIZATION_PROMPT.format(
-            task_names=', '.join([t.name for t in self.task_list]),
-            objective=self.objective,
-            next_task_id=int(this_task_id) + 1,
+        prioritized_tasks = [to_task(v) for v in response.split('\n') if to_task(v) is not None]
+        self.new_task_ids = set()
+        if self.prioritization_window is None and len(tasks) == len(self.task_list):
+            self.task_list.clear()
+            for task in prioritized_tasks:
+                self.task_list.push(task)
+            return
+        tasks_by_name = {}
+        for task in tasks:
+            tasks_by_name.setdefault(task.name, []).append(task)
+        head = []
+        for task in prioritized_tasks:
+            matches = tasks_by_name.get(task.name)
+            head.append(matches.pop(0) if matches else Task(name=task.name))
+        for matches in tasks_by_name.values():
+            for task in matches:
+                self.task_list.remove(task.id)
+        self.task_list.prepend(head)
+
+    def budgeted_prioritization_tasks(self, this_task_id):
+        tasks = self.prioritization_tasks()
+        if self.prompt_budget is None:
+            return tasks
+        return self.relevant_tasks(
+            tasks,
+            lambda selected: self.task_prioritization_prompt(this_task_id, selected),
+            self.prompt_budget.prioritization_tokens,
         )
-        new_tasks = self.ai_service.create(prompt, max_tokens=1000)
-        self.task_list = deque([to_task(v) for v in new_tasks.split('\n') if to_task(v) is not None])
 
-    def task_execution_agent(self, task):
-        task.result = self.ai_service.create(
-            prompt=EXECUTION_PROMPT.format(objective=self.objective, task=task),
-            max_tokens=2000,
-            temperature=0.7,
+    def task_prioritization_agent(self, this_task_id):
+        tasks = self.budgeted_prioritization_tasks(this_task_id)
+        prompt = self.task_prioritization_prompt(this_task_id, tasks)
+        with self.events.stage('prioritization', prompt=prompt) as fields:
+            response = fields['completion'] = self.ai_service.create(prompt, max_tokens=1000)
+            self.set_prioritized_tasks(response, tasks)
+
+    def task_execution_prompt(self, task, context=''):
+        return EXECUTION_PROMPT.format(objective=self.objective, context=context, task=task.name)
+
+    def task_execution_agent(self, task, context=''):
+        prompt = self.task_execution_prompt(task, context)
+        with self.events.stage('execution', prompt=prompt) as fields:
+            if self.on_token is None:
+                task.result = self.ai_service.create(prompt=prompt, max_tokens=2000, temperature=0.7)
+            else:
+                tokens = []
+                for token in self.ai_service.create(prompt=prompt, max_tokens=2000, temperature=0.7, stream=True):
+                    tokens.append(token)
+                    self.on_token(task, token)
+                task.result = ''.join(tokens).strip()
+            fields['completion'] = task.result
+
+    def execution_agent(self, tasks, pool):
+        contexts = self.retrieve(tasks)
+        list(pool.map(self.task_execution_agent, tasks, contexts))
+        self.embed(tasks)
+        self.upsert(tasks)
+
+    def retrieval_misses(self, tasks):
+        return list(dict.fromkeys(t.name for t in tasks if t.name not in self.retrievals))
+
+    def select_context(self, candidates):
+        # Candidates arrive in the store's similarity order; only drop empty and repeated results.
+        unique = {}
+        for task in candidates:
+            key = ' '.join(task.result.lower().split()) if task.result else ''
+            if key != '' and key not in unique:
+                unique[key] = task
+        return list(unique.values())[: self.retrieval_top_k]
+
+    def context_block(self, retrieved):
+        if len(retrieved) == 0:
+            return ''
+        max_tokens = self.context_tokens // len(retrieved)
+        return CONTEXT_PROMPT.format(
+            context='\n'.join(
+                f'- {t.name}: {truncate_tokens(t.result, max(0, max_tokens - count_tokens(t.name) - 2))}'
+                for t in retrieved
+            )
+        )
+
+    def cached_contexts(self, tasks, names, candidates):
+        for name, retrieved in zip(names, candidates):
+            self.retrievals[name] = self.context_block(self.select_context(retrieved))
+        contexts = []
+        for task in tasks:
+            contexts.append(self.retrievals.pop(task.name))
+            self.retrievals[task.name] = contexts[-1]
+        while len(self.retrievals) > self.retrieval_cache_size:
+            self.retrievals.pop(next(iter(self.retrievals)))
+        return contexts
+
+    def retrieve(self, tasks):
+        if self.retrieval_top_k == 0:
+            return [''] * len(tasks)
+        names = self.retrieval_misses(tasks)
+        with self.events.stage('retrieval', tasks=len(tasks), misses=len(names)):
+            vectors = self.ai_service.get_ada_embeddings(names) if len(names) > 0 else []
+            candidates = [self.query(vector, 2 * self.retrieval_top_k) for vector in vectors]
+            return self.cached_contexts(tasks, names, candidates)
+
+    def embed(self, tasks):
+        texts = self.embedding_texts(tasks)
+        with self.events.stage('embedding', prompt=texts, texts=len(texts)):
+            vectors = self.ai_service.get_ada_embeddings(texts)
+            for task, vector in zip(tasks, vectors):
+                task.vector = vector
+            if self.completed_names is not None:
+                self.remember_completed(tasks, vectors[len(tasks) :])
+
+    def upsert(self, tasks):
+        with self.events.stage('upsert', rows=len(tasks)):
+            self.vector_service.upsert_many(tasks)
+            self.retrievals.clear()
+
+    def query(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        with self.events.stage('query', top_k=top_k):
+            return self.vector_service.query(query_embedding, top_k, columns=columns)
+
+    def iteration_stats(self, fields):
+        fields['queue_depth'] = len(self.task_list)
+        if self.events.enabled and hasattr(self.ai_service, 'stats'):
+            fields['cache'] = self.ai_service.stats()
+
+    def resume(self):
+        tasks = self.vector_service.load_tasks()
+        if len(tasks) == 0:
+            return False
+        last_task = max(tasks, key=lambda t: t.id)
+        self.task_list.next_id = last_task.id + 1
+        self.task_list.completed_ids.update(t.id for t in tasks)
+        if self.completed_names is not None:
+            self.remember_completed(tasks, self.ai_service.get_ada_embeddings([t.name for t in tasks]))
+        self.task_creation_agent([last_task])
+        self.task_prioritization_agent(last_task.id)
+        return True
+
+    def run(self, first_task, resume=False, iterations=4):
+        if not (resume and self.resume()):
+            self.add_task(Task(name=first_task))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for iteration in range(iterations):
+                if len(self.task_list) == 0:
+                    return iteration
+                self.events.iteration = iteration
+                with self.events.stage('iteration') as fields:
+                    tasks = self.next_tasks()
+                    self.execution_agent(tasks, pool)
+                    self.task_creation_agent(tasks)
+                    self.task_prioritization_agent(tasks[-1].id)
+                    self.iteration_stats(fields)
+        return iterations
+
+
+class AsyncBabyAGI(BabyAGI):
+    async def relevant_tasks(self, tasks, build_prompt, max_tokens):
+        task_tokens = max_tokens - count_tokens(build_prompt([]))
+        if not self.prompt_budget.fits(tasks, task_tokens):
+            vectors = await self.ai_service.aget_ada_embeddings([t.name for t in tasks])
+            tasks = self.select_relevant(tasks, vectors, task_tokens)
+        return self.fit_tasks(tasks, build_prompt, max_tokens)
+
+    async def pending_tasks(self, tasks):
+        pending_tasks = list(self.task_list)
+        if self.prompt_budget is None:
+            return pending_tasks
+        results = self.creation_results(tasks)
+        return await self.relevant_tasks(
+            pending_tasks,
+            lambda pending: self.format_task_creation_prompt(tasks, results, pending),
+            self.prompt_budget.creation_tokens,
+        )
+
+    async def budgeted_prioritization_tasks(self, this_task_id):
+        tasks = self.prioritization_tasks()
+        if self.prompt_budget is None:
+            return tasks
+        return await self.relevant_tasks(
+            tasks,
+            lambda selected: self.task_prioritization_prompt(this_task_id, selected),
+            self.prompt_budget.prioritization_tokens,
+        )
+
+    async def task_creation_agent(self, tasks):
+        prompt = self.task_creation_prompt(tasks, await self.pending_tasks(tasks))
+        with self.events.stage('creation', prompt=prompt) as fields:
+            response = fields['completion'] = await self.ai_service.acreate(prompt)
+            task_names = response.split('\n')
+            if self.dedup_threshold is not None:
+                executions_saved = self.executions_saved
+                task_names = await self.deduplicate(task_names)
+                fields['executions_saved'] = self.executions_saved - executions_saved
+            self.add_created_tasks(task_names)
+
+    async def deduplicate(self, task_names):
+        candidates = self.dedup_candidates(task_names)
+        if len(candidates) == 0:
+            return self.select_unique(task_names, [], np.zeros((0, 0)), [])
+        names = self.unembedded_names(candidates)
+        vectors = self.dedup_vectors(
+            candidates, names, await self.ai_service.aget_ada_embeddings(names) if names else []
         )
-        task.vector = self.ai_service.get_ada_embedding(task.result)
-        self.vector_service.upsert(task)
+        completed = self.completed_matches(vectors[: len(candidates)])
+        return self.select_unique(task_names, candidates, vectors, completed)
+
+    async def task_prioritization_agent(self, this_task_id):
+        tasks = await self.budgeted_prioritization_tasks(this_task_id)
+        prompt = self.task_prioritization_prompt(this_task_id, tasks)
+        with self.events.stage('prioritization', prompt=prompt) as fields:
+            response = fields['completion'] = await self.ai_service.acreate(prompt, max_tokens=1000)
+            self.set_prioritized_tasks(response, tasks)
+
+    async def task_execution_agent(self, task, context=''):
+        prompt = self.task_execution_prompt(task, context)
+        with self.events.stage('execution', prompt=prompt) as fields:
+            if self.on_token is None:
+                task.result = await self.ai_service.acreate(prompt=prompt, max_tokens=2000, temperature=0.7)
+            else:
+                tokens = []
+                async for token in await self.ai_service.acreate(
+                    prompt=prompt, max_tokens=2000, temperature=0.7, stream=True
+                ):
+                    tokens.append(token)
+                    self.on_token(task, token)
+                task.result = ''.join(tokens).strip()
+            fields['completion'] = task.result
+
+    async def execution_agent(self, tasks):
+        contexts = await self.retrieve(tasks)
+        await asyncio.gather(*[self.task_execution_agent(task, context) for task, context in zip(tasks, contexts)])
+        await self.embed(tasks)
+
+    async def embed(self, tasks):
+        texts = self.embedding_texts(tasks)
+        with self.events.stage('embedding', prompt=texts, texts=len(texts)):
+            vectors = await self.ai_service.aget_ada_embeddings(texts)
+            for task, vector in zip(tasks, vectors):
+                task.vector = vector
+            if self.completed_names is not None:
+                self.remember_completed(tasks, vectors[len(tasks) :])
+
+    async def upsert(self, tasks):
+        with self.events.stage('upsert', rows=len(tasks)):
+            await self.vector_service.aupsert_many(tasks)
+            self.retrievals.clear()
+
+    async def query(self, query_embedding, top_k, columns=TASK_COLUMNS):
+        with self.events.stage('query', top_k=top_k):
+            return await self.vector_service.aquery(query_embedding, top_k, columns=columns)
+
+    async def retrieve(self, tasks):
+        if self.retrieval_top_k == 0:
+            return [''] * len(tasks)
+        names = self.retrieval_misses(tasks)
+        with self.events.stage('retrieval', tasks=len(tasks), misses=len(names)):
+            vectors = await self.ai_service.aget_ada_embeddings(names) if len(names) > 0 else []
+            candidates = await asyncio.gather(*[self.query(vector, 2 * self.retrieval_top_k) for vector in vectors])
+            return self.cached_contexts(tasks, names, candidates)
+
+    async def resume(self):
+        tasks = self.vector_service.load_tasks()
+        if len(tasks) == 0:
+            return False
+        last_task = max(tasks, key=lambda t: t.id)
+        self.task_list.next_id = last_task.id + 1
+        self.task_list.completed_ids.update(t.id for t in tasks)
+        if self.completed_names is not None:
+            self.remember_completed(tasks, await self.ai_service.aget_ada_embeddings([t.name for t in tasks]))
+        await self.task_creation_agent([last_task])
+        await self.task_prioritization_agent(last_task.id)
+        return True
+
+    async def aclose(self):
+        if hasattr(self.ai_service, 'aclose'):
+            await self.ai_service.aclose()
 
-    def run(self, first_task):
-        self.add_task(Task(name=first_task))
-        for _ in range(4):
-            if len(self.task_list) == 0:
-                exit(0)
-            context = self.vector_service.query(self.objective_embedding, 5)
-            task = self.task_list.popleft()
-            self.task_execution_agent(task)
-            self.task_creation_agent(task)
-            self.task_prioritization_agent(task.id)
+    async def run(self, first_task, resume=False, iterations=4):
+        try:
+            return await self.run_iterations(first_task, resume, iterations)
+        finally:
+            await self.aclose()
 
+    async def run_iterations(self, first_task, resume, iterations):
+        if not (resume and await self.resume()):
+            self.add_task(Task(name=first_task))
+        upsert = None
+        completed = 0
+        try:
+            for iteration in range(iterations):
+                if upsert is not None:
+                    await upsert
+                if len(self.task_list) == 0:
+                    break
+                self.events.iteration = iteration
+                with self.events.stage('iteration') as fields:
+                    tasks = self.next_tasks()
+                    await self.execution_agent(tasks)
+                    upsert = asyncio.ensure_future(self.upsert(tasks))
+                    await self.task_creation_agent(tasks)
+                    await self.task_prioritization_agent(tasks[-1].id)
+                    self.iteration_stats(fields)
+                completed += 1
+        finally:
+            if upsert is not None:
+                await upsert
+        return completed
 
-def main():
+
+def main(
+    use_async: bool = False,
+    workers: int = typer.Option(1, min=1),
+    resume: bool = False,
+    stream: bool = False,
+    prioritization_window: int = typer.Option(None, min=1),
+    dedup_threshold: float = typer.Option(None, min=0.0, max=1.0),
+    semantic_threshold: float = typer.Option(None, min=0.0, max=1.0),
+    cache_max_mb: int = typer.Option(None, min=1),
+    simulate: bool = False,
+    seed: int = 0,
+    metrics_jsonl: str = None,
+    metrics_prometheus: str = None,
+    prompt_tokens: int = typer.Option(None, min=256),
+    max_prompt_tasks: int = typer.Option(20, min=1),
+    result_tokens: int = typer.Option(500, min=0),
+    retrieval_top_k: int = typer.Option(5, min=0),
+    context_tokens: int = typer.Option(500, min=1),
+):
     load_dotenv()
-    baby_agi = BabyAGI(
-        objective='Solve world hunger.',
-        ai_service=TestAIService(
-            ai_service=OpenAIService(api_key=os.getenv('OPENAI_API_KEY')),
-            cache_file='babyagi_cache.pkl',
-        ),
-        vector_service=LanceService(
-            table_name='test-table',
+    events = EventBus()
+    if metrics_jsonl is not None:
+        events.subscribe(JsonLinesExporter(metrics_jsonl))
+    if metrics_prometheus is not None:
+        events.subscribe(PrometheusExporter(metrics_prometheus))
+    if simulate:
+        ai_service = SimulatedAIService(seed=seed, dimension=1536)
+    else:
+        ai_service = TestAIService(
+            ai_service=OpenAIService(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                completion_limiter=RateLimiter(requests_per_minute=3000, tokens_per_minute=250000),
+                embedding_limiter=RateLimiter(requests_per_minute=3000, tokens_per_minute=1000000),
+            ),
+            cache_file='babyagi_cache.sqlite',
+            embedding_file='babyagi_embeddings.f32',
             dimension=1536,
+            legacy_cache_file='babyagi_cache.pkl',
+            create_policy=EvictionPolicy(kind='lru', max_bytes=cache_max_mb * 2**20) if cache_max_mb else None,
+            ada_policy=EvictionPolicy(kind='lru', max_bytes=cache_max_mb * 2**20) if cache_max_mb else None,
         )
+    if semantic_threshold is not None:
+        ai_service = SemanticAIService(ai_service=ai_service, threshold=semantic_threshold, dimension=1536)
+    baby_agi = (AsyncBabyAGI if use_async else BabyAGI)(
+        objective='Solve world hunger.',
+        ai_service=ai_service,
+        vector_service=BufferedVectorService(
+            vector_service=LanceService(
+                table_name='test-table',
+                dimension=1536,
+                mode='open' if resume else 'overwrite',
+            ),
+        ),
         # vector_service=PineconeService(
         #     api_key=os.getenv('PINECONE_API_KEY'),
         #     environment=os.getenv('PINECONE_ENVIRONMENT'),
@@ -204,8 +2146,37 @@ def main():
         #     metric='cosine',
         #     pod_type='p1',
         # ),
+        # vector_service=NumpyService(
+        #     dimension=1536,
+        # ),
+        workers=workers,
+        on_token=(lambda task, token: typer.echo(token, nl=False)) if stream else None,
+        prioritization_window=prioritization_window,
+        dedup_threshold=dedup_threshold,
+        events=events,
+        prompt_budget=(
+            PromptBudget(
+                creation_tokens=prompt_tokens,
+                prioritization_tokens=prompt_tokens,
+                result_tokens=result_tokens,
+                max_tasks=max_prompt_tasks,
+            )
+            if prompt_tokens
+            else None
+        ),
+        retrieval_top_k=retrieval_top_k,
+        context_tokens=context_tokens,
     )
-    baby_agi.run(first_task='Develop a task list.')
+    try:
+        if use_async:
+            asyncio.run(baby_agi.run(first_task='Develop a task list.', resume=resume))
+        else:
+            baby_agi.run(first_task='Develop a task list.', resume=resume)
+        if dedup_threshold is not None:
+            typer.echo(f'\nExecutions saved by deduplication: {baby_agi.executions_saved}')
+    finally:
+        if hasattr(baby_agi.vector_service, 'close'):
+            baby_agi.vector_service.close()
 
 
 if __name__ == '__main__':
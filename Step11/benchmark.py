@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import asyncio
+import platform
+import tempfile
+from typing import List
+import typer
+import numpy as np
+from babyagi import Task, LanceService, NumpyService, TestAIService, SimulatedAIService, BabyAGI, AsyncBabyAGI
+
+
+app = typer.Typer()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def timings(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+    }
+
+
+def report(results, output):
+    text = json.dumps(
+        {'python': platform.python_version(), 'numpy': np.__version__, 'time': time.time(), 'results': results},
+        indent=2,
+    )
+    typer.echo(text)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+
+
+def measure_cache(sizes, lookups, dimension, seed):
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            ai_service = TestAIService(
+                ai_service=SimulatedAIService(seed=seed, dimension=dimension),
+                cache_file=os.path.join(directory, 'cache.sqlite'),
+                embedding_file=os.path.join(directory, 'embeddings.f32'),
+                dimension=dimension,
+            )
+            prompts = [f'prompt {i}' for i in range(size)]
+            ai_service.cache.put_many('create', [((prompt, 100, 0.5), 'response') for prompt in prompts])
+            ai_service.embeddings.put_many(list(zip(prompts, rng.standard_normal((size, dimension)))))
+            hits = [prompts[i] for i in rng.integers(0, size, lookups)]
+            misses = [f'miss {i}' for i in range(lookups)]
+            results.append(
+                {
+                    'size': size,
+                    'create_hit': timings([timed(ai_service.create, prompt) for prompt in hits]),
+                    'create_miss': timings([timed(ai_service.create, prompt) for prompt in misses]),
+                    'ada_hit': timings([timed(ai_service.get_ada_embedding, prompt) for prompt in hits]),
+                    'ada_miss': timings([timed(ai_service.get_ada_embedding, prompt) for prompt in misses]),
+                }
+            )
+    return results
+
+
+def measure_lance(rows, batch_size, queries, top_k, dimension, seed):
+    rng = np.random.default_rng(seed)
+    results = []
+    index_threshold = max(rows) + queries + 1
+    for row_count in rows:
+        with tempfile.TemporaryDirectory() as directory:
+            vector_service = LanceService(
+                table_name='benchmark-table', dimension=dimension, index_threshold=index_threshold, uri=directory
+            )
+            vectors = rng.standard_normal((row_count + queries, dimension)).astype(np.float32)
+            tasks = [Task(name=str(i), id=i, result='', vector=v) for i, v in enumerate(vectors)]
+            upsert_many = [
+                timed(vector_service.upsert_many, tasks[i : i + batch_size]) for i in range(0, row_count, batch_size)
+            ]
+            upsert = [timed(vector_service.upsert, task) for task in tasks[row_count:]]
+            query = [timed(vector_service.query, v.tolist(), top_k) for v in rng.standard_normal((queries, dimension))]
+        results.append(
+            {
+                'rows': row_count,
+                'upsert_many': timings(upsert_many),
+                'upsert': timings(upsert),
+                'query': timings(query),
+            }
+        )
+    return results
+
+
+def measure_queue(backlogs, repeat, dimension, seed):
+    results = []
+    for backlog in backlogs:
+        baby_agi = BabyAGI(
+            objective='Solve world hunger.',
+            ai_service=SimulatedAIService(seed=seed, dimension=dimension),
+            vector_service=NumpyService(dimension=dimension),
+        )
+        add_task = [timed(baby_agi.add_task, Task(name=f'Task {i}')) for i in range(backlog)]
+        tasks = baby_agi.prioritization_tasks()
+        prompt = baby_agi.task_prioritization_prompt(0, tasks)
+        response = baby_agi.ai_service.create(prompt, max_tokens=1000)
+        results.append(
+            {
+                'backlog': backlog,
+                'add_task': timings(add_task),
+                'prioritization_prompt': timings(
+                    [timed(baby_agi.task_prioritization_prompt, 0, tasks) for _ in range(repeat)]
+                ),
+                'set_prioritized_tasks': timings(
+                    [timed(baby_agi.set_prioritized_tasks, response, tasks) for _ in range(repeat)]
+                ),
+                'task_prioritization_agent': timings(
+                    [timed(baby_agi.task_prioritization_agent, 0) for _ in range(repeat)]
+                ),
+            }
+        )
+    return results
+
+
+def measure_loop(iterations, workers, use_async, latency, jitter, tokens_per_second, error_rate, dimension, seed):
+    baby_agi = (AsyncBabyAGI if use_async else BabyAGI)(
+        objective='Solve world hunger.',
+        ai_service=SimulatedAIService(
+            seed=seed,
+            dimension=dimension,
+            latency=latency,
+            jitter=jitter,
+            tokens_per_second=tokens_per_second,
+            error_rate=error_rate,
+        ),
+        vector_service=NumpyService(dimension=dimension),
+        workers=workers,
+    )
+    start = time.perf_counter()
+    if use_async:
+        completed = asyncio.run(baby_agi.run(first_task='Develop a task list.', iterations=iterations))
+    else:
+        completed = baby_agi.run(first_task='Develop a task list.', iterations=iterations)
+    seconds = time.perf_counter() - start
+    return {
+        'iterations': completed,
+        'workers': workers,
+        'use_async': use_async,
+        'latency': latency,
+        'seconds': seconds,
+        'iterations_per_second': completed / seconds,
+    }
+
+
+@app.command()
+def cache(
+    sizes: List[int] = typer.Option([100, 1000, 10000]),
+    lookups: int = 1000,
+    dimension: int = 1536,
+    seed: int = 0,
+    output: str = None,
+):
+    report(measure_cache(sizes, lookups, dimension, seed), output)
+
+
+@app.command()
+def lance(
+    rows: List[int] = typer.Option([1000, 10000, 50000]),
+    batch_size: int = 500,
+    queries: int = 100,
+    top_k: int = 5,
+    dimension: int = 1536,
+    seed: int = 0,
+    output: str = None,
+):
+    report(measure_lance(rows, batch_size, queries, top_k, dimension, seed), output)
+
+
+@app.command()
+def queue(
+    backlogs: List[int] = typer.Option([10, 100, 1000]),
+    repeat: int = 20,
+    dimension: int = 1536,
+    seed: int = 0,
+    output: str = None,
+):
+    report(measure_queue(backlogs, repeat, dimension, seed), output)
+
+
+@app.command()
+def loop(
+    iterations: int = 20,
+    workers: int = 1,
+    use_async: bool = False,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    tokens_per_second: float = None,
+    error_rate: float = 0.0,
+    dimension: int = 1536,
+    seed: int = 0,
+    output: str = None,
+):
+    report(
+        measure_loop(iterations, workers, use_async, latency, jitter, tokens_per_second, error_rate, dimension, seed),
+        output,
+    )
+
+
+@app.command()
+def suite(dimension: int = 1536, seed: int = 0, output: str = None):
+    report(
+        {
+            'cache': measure_cache([100, 1000, 10000], 1000, dimension, seed),
+            'lance': measure_lance([1000, 10000], 500, 100, 5, dimension, seed),
+            'queue': measure_queue([10, 100, 1000], 20, dimension, seed),
+            'loop': [
+                measure_loop(20, workers, use_async, 0.05, 0.02, None, 0.0, dimension, seed)
+                for workers in (1, 4)
+                for use_async in (False, True)
+            ],
+        },
+        output,
+    )
+
+
+@app.command()
+def recall(
+    rows: int = 20000,
+    queries: int = 100,
+    top_k: int = 5,
+    dimension: int = 1536,
+    nprobes: int = 20,
+    refine_factor: int = 10,
+    seed: int = 0,
+    output: str = None,
+):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((rows, dimension)).astype(np.float32)
+    hits = 0
+    with tempfile.TemporaryDirectory() as directory:
+        vector_service = LanceService(
+            table_name='benchmark-table', dimension=dimension, index_threshold=rows, uri=directory
+        )
+        vector_service.upsert_many([Task(name=str(i), id=i, result='', vector=v) for i, v in enumerate(vectors)])
+        for query_embedding in rng.standard_normal((queries, dimension)).astype(np.float32):
+            exact = np.argpartition(((vectors - query_embedding) ** 2).sum(axis=1), top_k)[:top_k]
+            found = vector_service.query(
+                query_embedding.tolist(), top_k, columns=('id', 'name'), nprobes=nprobes, refine_factor=refine_factor
+            )
+            hits += len(set(exact.tolist()) & {t.id for t in found})
+    report({'rows': rows, 'top_k': top_k, 'nprobes': nprobes, 'recall': hits / (queries * top_k)}, output)
+
+
+if __name__ == '__main__':
+    app()
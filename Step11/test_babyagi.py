@@ -0,0 +1,849 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import http.server
+import pytest
+import numpy as np
+import openai
+import babyagi
+from babyagi import Task, TaskQueue, RateLimiter, OpenAIService, SimulatedAIService, NumpyService, BabyAGI
+from babyagi import EvictionPolicy, EmbeddingStore, SqliteCache, PromptBudget, LanceService, count_tokens
+from babyagi import SemanticAIService, normalize_prompt, PRIORITIZATION_PROMPT, EXECUTION_PROMPT
+
+
+class FakeOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        if self.server.requests <= self.server.failures:
+            status, body = 429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}}
+        else:
+            status, body = 200, {'object': 'text_completion', 'choices': [{'text': ' hello', 'index': 0}]}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_openai():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAIHandler)
+    server.requests = 0
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def openai_service(server, max_retries):
+    return OpenAIService(
+        api_key='test',
+        api_base=f'http://127.0.0.1:{server.server_address[1]}/v1',
+        max_retries=max_retries,
+        backoff=0.001,
+        max_backoff=0.01,
+    )
+
+
+def test_create_retries_rate_limit_errors(fake_openai):
+    fake_openai.failures = 3
+    assert openai_service(fake_openai, max_retries=3).create('prompt') == 'hello'
+    assert fake_openai.requests == 4
+
+
+def test_create_raises_after_max_retries(fake_openai):
+    fake_openai.failures = 10
+    with pytest.raises(openai.error.RateLimitError):
+        openai_service(fake_openai, max_retries=2).create('prompt')
+    assert fake_openai.requests == 3
+
+
+def test_acreate_retries_rate_limit_errors(fake_openai):
+    fake_openai.failures = 2
+    ai_service = openai_service(fake_openai, max_retries=3)
+
+    async def create():
+        try:
+            return await ai_service.acreate('prompt')
+        finally:
+            await ai_service.aclose()
+
+    assert asyncio.run(create()) == 'hello'
+    assert fake_openai.requests == 3
+
+
+def test_rate_limiter_reserve(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(babyagi.time, 'monotonic', lambda: now[0])
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+    assert limiter.reserve(100) == 0
+    assert limiter.reserve(600) == pytest.approx(10.0)
+    now[0] = 10.0
+    assert limiter.reserve(0) == pytest.approx(0.0)
+    assert limiter.reserve(300) == pytest.approx(30.0)
+
+
+def windowed_baby_agi(task_names):
+    baby_agi = BabyAGI(
+        objective='Solve world hunger.',
+        ai_service=SimulatedAIService(dimension=8),
+        vector_service=NumpyService(dimension=8),
+        prioritization_window=5,
+    )
+    for task_name in task_names:
+        baby_agi.add_task(Task(name=task_name))
+    return baby_agi
+
+
+def test_windowed_prioritization_keeps_repeated_names():
+    baby_agi = windowed_baby_agi(['x', 'x', 'y'])
+    for _ in range(3):
+        tasks = baby_agi.prioritization_tasks()
+        baby_agi.set_prioritized_tasks('\n'.join(f'{i + 1}. {t.name}' for i, t in enumerate(tasks)), tasks)
+    assert [t.name for t in baby_agi.task_list] == ['x', 'x', 'y']
+
+
+def test_windowed_prioritization_removes_unreturned_tasks():
+    baby_agi = windowed_baby_agi(['x', 'x', 'y', ''])
+    tasks = baby_agi.prioritization_tasks()
+    baby_agi.set_prioritized_tasks('1. y\n2. x\n3.', tasks)
+    assert [t.name for t in baby_agi.task_list] == ['y', 'x']
+
+
+def test_add_created_tasks_skips_blank_names():
+    baby_agi = windowed_baby_agi([])
+    baby_agi.add_created_tasks(['', 'a', '  '])
+    assert [t.name for t in baby_agi.task_list] == ['a']
+
+
+def test_task_queue_push_pop_is_fifo():
+    queue = TaskQueue()
+    for name in 'abc':
+        queue.push(Task(name=name))
+    assert [t.id for t in queue] == [1, 2, 3]
+    assert [queue.pop().name for _ in range(3)] == ['a', 'b', 'c']
+    assert len(queue) == 0
+
+
+def test_task_queue_push_assigns_fresh_id_on_collision():
+    queue = TaskQueue()
+    queue.push(Task(name='a', id=2))
+    queue.push(Task(name='b', id=2))
+    assert [(t.id, t.name) for t in queue] == [(2, 'a'), (3, 'b')]
+
+
+def test_task_queue_prepend_moves_existing_tasks():
+    queue = TaskQueue()
+    tasks = [Task(name=name) for name in 'abcd']
+    for task in tasks:
+        queue.push(task)
+    queue.prepend([tasks[3], tasks[2]])
+    assert [t.name for t in queue] == ['d', 'c', 'a', 'b']
+    queue.prepend([Task(name='e')])
+    assert [t.name for t in queue] == ['e', 'd', 'c', 'a', 'b']
+    assert len(queue) == 5
+
+
+def test_task_queue_remove():
+    queue = TaskQueue()
+    for name in 'abc':
+        queue.push(Task(name=name))
+    queue.remove(2)
+    assert 2 not in queue and 3 in queue
+    assert [queue.pop().name for _ in range(len(queue))] == ['a', 'c']
+
+
+def test_task_queue_compacts_heap_after_removals():
+    queue = TaskQueue()
+    for i in range(200):
+        queue.push(Task(name=str(i)))
+    for task_id in range(1, 191):
+        queue.remove(task_id)
+    assert len(queue.heap) <= 2 * len(queue) + 64
+    assert [queue.pop().name for _ in range(len(queue))] == [str(i) for i in range(190, 200)]
+
+
+def test_prioritization_keeps_tasks_with_repeated_numbers():
+    baby_agi = windowed_baby_agi(['a', 'b', 'c'])
+    baby_agi.prioritization_window = None
+    tasks = baby_agi.prioritization_tasks()
+    baby_agi.set_prioritized_tasks('2. a\n2. b\n3. c', tasks)
+    assert [t.name for t in baby_agi.task_list] == ['a', 'b', 'c']
+    assert len({t.id for t in baby_agi.task_list}) == 3
+
+
+def test_deduplicate_drops_names_of_completed_tasks():
+    baby_agi = BabyAGI(
+        objective='Solve world hunger.',
+        ai_service=SimulatedAIService(dimension=8),
+        vector_service=NumpyService(dimension=8),
+        dedup_threshold=0.95,
+    )
+    task = Task(name='Research crop yields', id=1, result='Yields are up.')
+    baby_agi.embed([task])
+    assert baby_agi.deduplicate(['Research crop yields', '', 'Map markets', 'Map markets']) == ['Map markets']
+    assert baby_agi.executions_saved == 2
+
+
+def test_normalize_prompt_sorts_only_the_task_list():
+    def prompt(task_names, objective):
+        return PRIORITIZATION_PROMPT.format(task_names=task_names, objective=objective, next_task_id=2)
+
+    assert normalize_prompt(prompt('b, a', 'Feed people, fast.')) == normalize_prompt(
+        prompt('a, b', 'Feed people, fast.')
+    )
+    assert normalize_prompt(prompt('a, b', 'Feed people, fast.')) != normalize_prompt(
+        prompt('a, b', 'fast, Feed people.')
+    )
+
+
+def test_semantic_matching_skips_prioritization_prompts():
+    ai_service = SemanticAIService(SimulatedAIService(dimension=8), threshold=-1.0, dimension=8)
+    ai_service.create(PRIORITIZATION_PROMPT.format(task_names='a, b', objective='o', next_task_id=2), 1000)
+    ai_service.create(PRIORITIZATION_PROMPT.format(task_names='a, b, c', objective='o', next_task_id=2), 1000)
+    ai_service.create(EXECUTION_PROMPT.format(objective='o', context='', task='a'))
+    ai_service.create(EXECUTION_PROMPT.format(objective='o', context='', task='b'))
+    assert ai_service.stats()['semantic']['misses'] == 3
+    assert ai_service.stats()['semantic']['semantic_hits'] == 1
+
+
+def test_embedding_store_hit_detects_slot_reused_by_another_store(tmp_path):
+    policy = EvictionPolicy(kind='lru', max_entries=1)
+    first = EmbeddingStore(str(tmp_path / 'embeddings.f32'), 4, policy=policy)
+    second = EmbeddingStore(str(tmp_path / 'embeddings.f32'), 4, policy=policy)
+    first.put('alpha', [1, 1, 1, 1])
+    assert first.get('alpha') == [1, 1, 1, 1]
+    second.put('beta', [2, 2, 2, 2])
+    second.put('gamma', [3, 3, 3, 3])
+    assert first.get('alpha') is None
+    assert first.get('gamma') == [3, 3, 3, 3]
+
+
+def test_release_keeps_a_lease_taken_over_after_expiry(tmp_path):
+    cache = SqliteCache(os.path.join(tmp_path, 'cache.sqlite'))
+    expired = cache.try_lease('create', 'key', 0.01)
+    time.sleep(0.02)
+    assert cache.try_lease('create', 'key', 60) is not None
+    cache.release([('create', 'key', expired)])
+    assert cache.try_lease('create', 'key', 60) is None
+
+
+def budgeted_creation_prompt(creation_tokens):
+    baby_agi = BabyAGI(
+        objective='Solve world hunger.',
+        ai_service=SimulatedAIService(dimension=8),
+        vector_service=NumpyService(dimension=8),
+        prompt_budget=PromptBudget(creation_tokens=creation_tokens),
+    )
+    for i in range(30):
+        baby_agi.add_task(Task(name=f'Survey food supply in region {i}'))
+    task = Task(name='Research crop yields', id=100, result=' '.join(['yield'] * 3000))
+    pending_tasks = baby_agi.pending_tasks([task])
+    return pending_tasks, baby_agi.task_creation_prompt([task], pending_tasks)
+
+
+@pytest.mark.parametrize('creation_tokens', [256, 400, 1500])
+def test_task_creation_prompt_stays_within_budget(creation_tokens):
+    pending_tasks, prompt = budgeted_creation_prompt(creation_tokens)
+    assert len(pending_tasks) > 0
+    assert count_tokens(prompt) <= creation_tokens
+
+
+def test_count_tokens_uses_the_tiktoken_encoder():
+    tiktoken = pytest.importorskip('tiktoken')
+    encoding = tiktoken.get_encoding('p50k_base')
+    text = 'Solve world hunger, one task at a time.'
+    assert count_tokens(text) == len(encoding.encode(text))
+    for creation_tokens in [256, 400, 1500]:
+        assert len(encoding.encode(budgeted_creation_prompt(creation_tokens)[1])) <= creation_tokens
+
+
+def test_prioritization_keeps_the_model_numbering():
+    baby_agi = windowed_baby_agi(['a', 'b', 'c'])
+    baby_agi.prioritization_window = None
+    baby_agi.task_list.pop()
+    tasks = baby_agi.prioritization_tasks()
+    baby_agi.set_prioritized_tasks('2. c\n3. b\n4. d', tasks)
+    assert [(t.id, t.name) for t in baby_agi.task_list] == [(2, 'c'), (3, 'b'), (4, 'd')]
+
+
+def test_task_queue_push_does_not_reuse_completed_ids():
+    queue = TaskQueue()
+    queue.push(Task(name='a'))
+    queue.pop()
+    queue.push(Task(name='b', id=1))
+    assert [(t.id, t.name) for t in queue] == [(2, 'b')]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(babyagi.time, 'time', lambda: now[0])
+
+    def tick(seconds=1.0):
+        now[0] += seconds
+
+    return tick
+
+
+def sqlite_cache(tmp_path, **policy):
+    return SqliteCache(os.path.join(tmp_path, 'cache.sqlite'), policies={'create': EvictionPolicy(**policy)})
+
+
+def embedding_store(tmp_path, **policy):
+    return EmbeddingStore(os.path.join(tmp_path, 'embeddings.f32'), 4, policy=EvictionPolicy(**policy))
+
+
+def cached_keys(cache, keys):
+    return [key for key in keys if cache.get('create', key, count=False) is not None]
+
+
+def stored_texts(store, texts):
+    return [text for text in texts if store.get(text, count=False) is not None]
+
+
+def test_sqlite_cache_lru_evicts_least_recently_used(tmp_path, clock):
+    cache = sqlite_cache(tmp_path, kind='lru', max_entries=2)
+    for key in ['a', 'b']:
+        cache.put('create', key, key)
+        clock()
+    cache.get('create', 'a')
+    clock()
+    cache.put('create', 'c', 'c')
+    assert cached_keys(cache, ['a', 'b', 'c']) == ['a', 'c']
+
+
+def test_sqlite_cache_lfu_evicts_least_frequently_used(tmp_path, clock):
+    cache = sqlite_cache(tmp_path, kind='lfu', max_entries=2)
+    for key in ['a', 'b']:
+        cache.put('create', key, key)
+        clock()
+    for key in ['a', 'a', 'b']:
+        cache.get('create', key)
+        clock()
+    cache.put('create', 'c', 'c')
+    assert cached_keys(cache, ['a', 'b', 'c']) == ['a', 'b']
+
+
+def test_sqlite_cache_ttl_expires_entries(tmp_path, clock):
+    cache = sqlite_cache(tmp_path, ttl=10)
+    cache.put('create', 'a', 'a')
+    clock(5)
+    assert cache.get('create', 'a') == 'a'
+    clock(6)
+    assert cache.get('create', 'a') is None
+    assert cache.stats('create')['evictions'] == 1
+
+
+def test_sqlite_cache_byte_cap_counts_keys(tmp_path, clock):
+    cache = sqlite_cache(tmp_path, max_bytes=25000)
+    for i in range(5):
+        cache.put('create', (f'{i} ' + 'x' * 10000, 100, 0.5), 'short')
+        clock()
+    stats = cache.stats('create')
+    assert stats['entries'] == 2
+    assert 20000 < stats['bytes'] <= 25000
+    assert stats['evictions'] == 3
+
+
+def test_embedding_store_lru_evicts_least_recently_used(tmp_path, clock):
+    store = embedding_store(tmp_path, kind='lru', max_entries=2)
+    for text in ['a', 'b']:
+        store.put(text, [1, 2, 3, 4])
+        clock()
+    store.get('a')
+    clock()
+    store.put('c', [1, 2, 3, 4])
+    assert stored_texts(store, ['a', 'b', 'c']) == ['a', 'c']
+
+
+def test_embedding_store_lfu_evicts_least_frequently_used(tmp_path, clock):
+    store = embedding_store(tmp_path, kind='lfu', max_entries=2)
+    for text in ['a', 'b']:
+        store.put(text, [1, 2, 3, 4])
+        clock()
+    for text in ['a', 'a', 'b']:
+        store.get(text)
+        clock()
+    store.put('c', [1, 2, 3, 4])
+    assert stored_texts(store, ['a', 'b', 'c']) == ['a', 'b']
+
+
+def test_embedding_store_ttl_expires_entries(tmp_path, clock):
+    store = embedding_store(tmp_path, ttl=10)
+    store.put('a', [1, 2, 3, 4])
+    clock(5)
+    assert store.get('a') == [1, 2, 3, 4]
+    clock(6)
+    assert store.get('a') is None
+    assert store.stats()['evictions'] == 1
+
+
+def test_embedding_store_byte_cap(tmp_path, clock):
+    store = embedding_store(tmp_path, max_bytes=3 * 4 * 4)
+    for text in 'abcde':
+        store.put(text, [1, 2, 3, 4])
+        clock()
+    assert stored_texts(store, list('abcde')) == ['c', 'd', 'e']
+    assert store.stats()['bytes'] == 48
+
+
+def test_async_cache_calls_run_off_the_event_loop(tmp_path):
+    ai_service = babyagi.TestAIService(
+        SimulatedAIService(dimension=4),
+        os.path.join(tmp_path, 'cache.sqlite'),
+        os.path.join(tmp_path, 'embeddings.f32'),
+        4,
+    )
+    threads = set()
+    for target, name in [(ai_service.cache, 'get'), (ai_service.cache, 'put'), (ai_service.embeddings, 'put_many')]:
+
+        def spy(*args, method=getattr(target, name), **kwargs):
+            threads.add(threading.current_thread())
+            return method(*args, **kwargs)
+
+        setattr(target, name, spy)
+
+    async def run():
+        await ai_service.acreate('prompt')
+        await ai_service.aget_ada_embeddings(['a', 'b'])
+
+    asyncio.run(run())
+    assert len(threads) > 0 and threading.main_thread() not in threads
+
+
+class CountingNumpyService(NumpyService):
+    def __init__(self, dimension):
+        super().__init__(dimension)
+        self.queries = []
+
+    def query(self, query_embedding, top_k, columns=babyagi.TASK_COLUMNS):
+        self.queries.append(columns)
+        return super().query(query_embedding, top_k, columns)
+
+
+def retrieval_baby_agi(results, **kwargs):
+    ai_service = SimulatedAIService(dimension=8)
+    vector_service = CountingNumpyService(dimension=8)
+    names = [f'Task {i}' for i in range(len(results))]
+    vectors = ai_service.get_ada_embeddings(names)
+    for i, (name, result, vector) in enumerate(zip(names, results, vectors)):
+        vector_service.upsert(Task(name=name, id=i + 1, result=result, vector=vector))
+    baby_agi = BabyAGI('Solve world hunger.', ai_service, vector_service, **kwargs)
+    return baby_agi, vector_service
+
+
+def test_retrieve_drops_empty_and_repeated_results():
+    baby_agi, vector_service = retrieval_baby_agi(['Same result.', ' same  RESULT. ', '', 'Other result.'])
+    [context] = baby_agi.retrieve([Task(name='Map markets')])
+    assert context.lower().count('same') == 1
+    assert 'Other result.' in context
+    assert all('vector' not in columns for columns in vector_service.queries)
+
+
+def test_retrieve_truncates_results_to_context_tokens():
+    baby_agi, _ = retrieval_baby_agi([' '.join(['word'] * 1000)] * 2, context_tokens=100)
+    baby_agi.retrieval_top_k = 1
+    [context] = baby_agi.retrieve([Task(name='Map markets')])
+    assert 0 < count_tokens(context) - count_tokens(babyagi.CONTEXT_PROMPT.format(context='')) <= 100
+
+
+def test_retrieve_caches_by_name_until_the_next_upsert():
+    baby_agi, vector_service = retrieval_baby_agi(['First result.'])
+    baby_agi.retrieve([Task(name='Map markets')])
+    assert baby_agi.retrieve([Task(name='Map markets')])[0] == baby_agi.retrieve([Task(name='Map markets')])[0]
+    assert len(vector_service.queries) == 1
+    task = Task(name='Survey farms', id=2, result='Second result.')
+    baby_agi.embed([task])
+    baby_agi.upsert([task])
+    assert 'Second result.' in baby_agi.retrieve([Task(name='Map markets')])[0]
+    assert len(vector_service.queries) == 2
+
+
+@pytest.fixture
+def lance_uri(tmp_path):
+    pytest.importorskip('lancedb')
+    return str(tmp_path)
+
+
+def lance_tasks(count, dimension=16, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+    return [Task(name=f'Task {i}', id=i + 1, result=f'Result {i}', vector=v) for i, v in enumerate(vectors)]
+
+
+def lance_service(uri, mode='overwrite', **kwargs):
+    return LanceService('test-table', 16, mode=mode, uri=uri, num_partitions=2, num_sub_vectors=4, **kwargs)
+
+
+def test_lance_creates_an_empty_table(lance_uri):
+    vector_service = lance_service(lance_uri)
+    assert vector_service.load_tasks() == []
+    assert vector_service.indexed_rows == 0
+
+
+def test_lance_upsert_many_and_query_columns(lance_uri):
+    vector_service = lance_service(lance_uri)
+    tasks = lance_tasks(20)
+    vector_service.upsert_many(tasks)
+    [task] = vector_service.query(tasks[7].vector.tolist(), 1, columns=('id', 'name'))
+    assert (task.id, task.name, task.result, task.vector) == (8, 'Task 7', None, None)
+    [task] = vector_service.query(tasks[7].vector.tolist(), 1, columns=('id', 'vector'))
+    assert np.allclose(task.vector, tasks[7].vector)
+
+
+def test_lance_reopen_loads_tasks(lance_uri):
+    lance_service(lance_uri).upsert_many(lance_tasks(10))
+    vector_service = lance_service(lance_uri, mode='open')
+    assert sorted((t.id, t.name, t.result) for t in vector_service.load_tasks()) == [
+        (i + 1, f'Task {i}', f'Result {i}') for i in range(10)
+    ]
+    assert vector_service.indexed_rows == 0
+
+
+def test_lance_indexes_past_the_threshold(lance_uri):
+    vector_service = lance_service(lance_uri, index_threshold=300, reindex_ratio=0.5)
+    tasks = lance_tasks(500)
+    vector_service.upsert_many(tasks[:299])
+    assert vector_service.indexed_rows == 0
+    vector_service.upsert_many(tasks[299:300])
+    assert vector_service.indexed_rows == 300
+    vector_service.upsert_many(tasks[300:400])
+    assert vector_service.indexed_rows == 300
+    vector_service.upsert_many(tasks[400:450])
+    assert vector_service.indexed_rows == 450
+    assert lance_service(lance_uri, mode='open').indexed_rows == 450
+    assert len(vector_service.query(tasks[0].vector.tolist(), 5)) == 5
+
+
+class RecordingAIService(SimulatedAIService):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.embedded = []
+
+    def get_ada_embeddings(self, texts):
+        self.embedded += texts
+        return super().get_ada_embeddings(texts)
+
+
+def test_deduplicate_embeds_pending_names_once_and_reports_savings():
+    events = []
+    ai_service = RecordingAIService(dimension=8)
+    baby_agi = BabyAGI(
+        objective='Solve world hunger.',
+        ai_service=ai_service,
+        vector_service=NumpyService(dimension=8),
+        dedup_threshold=0.95,
+        events=babyagi.EventBus([events.append]),
+    )
+    baby_agi.add_task(Task(name='Map markets'))
+    ai_service.embedded = []
+    ai_service.create = lambda prompt, *args, **kwargs: 'Map markets\nSurvey farms\nSurvey farms'
+    baby_agi.task_creation_agent([Task(name='Research crop yields', id=1, result='Yields are up.')])
+    ai_service.create = lambda prompt, *args, **kwargs: 'Survey farms\nPlan storage'
+    baby_agi.task_creation_agent([Task(name='Research crop yields', id=1, result='Yields are up.')])
+    assert sorted(ai_service.embedded) == ['Map markets', 'Plan storage', 'Survey farms']
+    assert [t.name for t in baby_agi.task_list] == ['Map markets', 'Survey farms', 'Plan storage']
+    assert [e['executions_saved'] for e in events if e['event'] == 'creation'] == [2, 1]
+
+
+def test_event_bus_without_subscribers_skips_timing():
+    events = babyagi.EventBus()
+    assert isinstance(events.stage('creation', prompt='unused'), babyagi.NullStage)
+    with events.stage('creation') as fields:
+        fields['completion'] = 'ignored'
+
+
+def test_event_bus_emits_token_counts():
+    emitted = []
+    events = babyagi.EventBus([emitted.append])
+    events.iteration = 3
+    with events.stage('creation', prompt='one two three four') as fields:
+        fields['completion'] = 'five six'
+    [event] = emitted
+    assert (event['event'], event['iteration']) == ('creation', 3)
+    assert (event['prompt_tokens'], event['completion_tokens']) == (
+        count_tokens('one two three four'),
+        count_tokens('five six'),
+    )
+    assert 'prompt' not in event and event['seconds'] >= 0
+
+
+def test_json_lines_exporter_appends_one_event_per_line(tmp_path):
+    path = os.path.join(tmp_path, 'metrics.jsonl')
+    exporter = babyagi.JsonLinesExporter(path)
+    exporter({'event': 'creation', 'seconds': 0.5})
+    exporter({'event': 'iteration', 'seconds': 1.0})
+    with open(path) as f:
+        assert [json.loads(line)['event'] for line in f] == ['creation', 'iteration']
+
+
+def test_prometheus_exporter_render():
+    exporter = babyagi.PrometheusExporter()
+    exporter({'event': 'creation', 'seconds': 0.5, 'prompt_tokens': 10, 'completion_tokens': 4, 'executions_saved': 2})
+    exporter({'event': 'creation', 'seconds': 0.25, 'prompt_tokens': 6})
+    exporter({'event': 'iteration', 'seconds': 1.0, 'queue_depth': 7, 'cache': {'create': {'hits': 3}}})
+    assert exporter.render() == (
+        '# TYPE babyagi_stage_seconds summary\n'
+        'babyagi_stage_seconds_sum{stage="creation"} 0.75\n'
+        'babyagi_stage_seconds_count{stage="creation"} 2\n'
+        'babyagi_stage_seconds_sum{stage="iteration"} 1.0\n'
+        'babyagi_stage_seconds_count{stage="iteration"} 1\n'
+        '# TYPE babyagi_tokens_total counter\n'
+        'babyagi_tokens_total{stage="creation",kind="completion"} 4\n'
+        'babyagi_tokens_total{stage="creation",kind="prompt"} 16\n'
+        '# TYPE babyagi_executions_saved_total counter\n'
+        'babyagi_executions_saved_total 2\n'
+        '# TYPE babyagi_cache gauge\n'
+        'babyagi_cache{stat="create_hits"} 3\n'
+        '# TYPE babyagi_queue_depth gauge\n'
+        'babyagi_queue_depth 7\n'
+    )
+
+
+def test_semantic_stats_include_the_wrapped_cache(tmp_path):
+    cache = babyagi.TestAIService(
+        SimulatedAIService(dimension=8),
+        os.path.join(tmp_path, 'cache.sqlite'),
+        os.path.join(tmp_path, 'embeddings.f32'),
+        8,
+    )
+    ai_service = SemanticAIService(cache, threshold=0.99, dimension=8)
+    ai_service.create(EXECUTION_PROMPT.format(objective='o', context='', task='a'))
+    stats = ai_service.stats()
+    assert stats['semantic']['misses'] == 1
+    assert stats['create']['misses'] == 1 and stats['ada']['misses'] >= 1
+
+
+class SlowUpsertService(NumpyService):
+    def __init__(self, dimension, log):
+        super().__init__(dimension)
+        self.log = log
+
+    async def aupsert_many(self, tasks):
+        self.log.append('upsert')
+        await asyncio.sleep(0.05)
+        self.upsert_many(tasks)
+        self.log.append('upserted')
+
+    async def aquery(self, query_embedding, top_k, columns=babyagi.TASK_COLUMNS):
+        self.log.append('query')
+        return self.query(query_embedding, top_k, columns)
+
+
+class LoggingAsyncBabyAGI(babyagi.AsyncBabyAGI):
+    async def task_creation_agent(self, tasks):
+        self.vector_service.log.append('creation')
+        await super().task_creation_agent(tasks)
+        self.vector_service.log.append('created')
+
+
+def test_async_upsert_overlaps_creation_and_finishes_before_the_next_retrieval():
+    log = []
+    baby_agi = LoggingAsyncBabyAGI(
+        'Solve world hunger.', SimulatedAIService(dimension=8), SlowUpsertService(8, log), retrieval_top_k=2
+    )
+    assert asyncio.run(baby_agi.run('Develop a task list.', iterations=3)) == 3
+    assert log == ['query', 'creation', 'upsert', 'created', 'upserted'] * 3
+
+
+def test_async_run_awaits_the_pending_upsert_when_creation_fails():
+    log = []
+
+    class FailingAsyncBabyAGI(babyagi.AsyncBabyAGI):
+        async def task_creation_agent(self, tasks):
+            raise RuntimeError('creation failed')
+
+    vector_service = SlowUpsertService(8, log)
+    baby_agi = FailingAsyncBabyAGI('Solve world hunger.', SimulatedAIService(dimension=8), vector_service)
+    with pytest.raises(RuntimeError):
+        asyncio.run(baby_agi.run('Develop a task list.', iterations=3))
+    assert log[-1] == 'upserted'
+    assert [t.name for t in vector_service.load_tasks()] == ['Develop a task list.']
+
+
+class BarrierAIService(SimulatedAIService):
+    def __init__(self, parties, **kwargs):
+        super().__init__(**kwargs)
+        self.barrier = threading.Barrier(parties, timeout=5)
+
+    def create(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        if 'performs one task' in prompt:
+            self.barrier.wait()
+        return super().create(prompt, max_tokens, temperature, stream)
+
+
+def test_workers_execute_a_batch_of_tasks_concurrently():
+    baby_agi = BabyAGI(
+        'Solve world hunger.', BarrierAIService(3, dimension=8), NumpyService(dimension=8), workers=3, retrieval_top_k=0
+    )
+    for name in ['a', 'b', 'c', 'd']:
+        baby_agi.add_task(Task(name=name))
+    tasks = baby_agi.next_tasks()
+    assert [t.name for t in tasks] == ['a', 'b', 'c']
+    with babyagi.ThreadPoolExecutor(max_workers=3) as pool:
+        baby_agi.execution_agent(tasks, pool)
+    assert all(t.result for t in tasks)
+    assert sorted(t.name for t in baby_agi.vector_service.load_tasks()) == ['a', 'b', 'c']
+    assert 'based on this task description: a, b, c.' in baby_agi.task_creation_prompt(tasks)
+    assert [t.name for t in baby_agi.next_tasks()] == ['d']
+
+
+def buffered_service(**kwargs):
+    backend = NumpyService(dimension=4)
+    return backend, babyagi.BufferedVectorService(backend, **kwargs)
+
+
+def vector_tasks(names):
+    return [Task(name=name, id=i + 1, result=name, vector=[i + 1, 0, 0, 0]) for i, name in enumerate(names)]
+
+
+def test_buffered_vector_service_reads_its_own_writes():
+    backend, vector_service = buffered_service(max_size=10, max_delay=60)
+    vector_service.upsert_many(vector_tasks(['a', 'b']))
+    assert backend.load_tasks() == []
+    assert [t.name for t in vector_service.query([1, 0, 0, 0], 1)] == ['b']
+    vector_service.upsert(Task(name='c', id=3, result='c', vector=[0, 1, 0, 0]))
+    assert [t.name for t in vector_service.load_tasks()] == ['a', 'b', 'c']
+    vector_service.close()
+
+
+def test_buffered_vector_service_flushes_when_full():
+    backend, vector_service = buffered_service(max_size=3, max_delay=60)
+    tasks = vector_tasks(['a', 'b', 'c', 'd'])
+    vector_service.upsert_many(tasks[:2])
+    assert backend.load_tasks() == []
+    vector_service.upsert(tasks[2])
+    assert [t.name for t in backend.load_tasks()] == ['a', 'b', 'c']
+    vector_service.upsert(tasks[3])
+    vector_service.close()
+    assert [t.name for t in backend.load_tasks()] == ['a', 'b', 'c', 'd']
+
+
+def test_buffered_vector_service_flushes_after_max_delay():
+    backend, vector_service = buffered_service(max_size=10, max_delay=0.05)
+    vector_service.upsert_many(vector_tasks(['a']))
+    deadline = time.monotonic() + 5
+    while backend.load_tasks() == [] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [t.name for t in backend.load_tasks()] == ['a']
+    assert vector_service.timer is None
+
+
+def test_buffered_vector_service_async_reads_its_own_writes():
+    backend, vector_service = buffered_service(max_size=10, max_delay=60)
+
+    async def run():
+        await vector_service.aupsert_many(vector_tasks(['a', 'b']))
+        return await vector_service.aquery([1, 0, 0, 0], 2)
+
+    assert [t.name for t in asyncio.run(run())] == ['b', 'a']
+    vector_service.close()
+
+
+class CountingAIService(SimulatedAIService):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = 0
+
+    def create(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        self.calls += 1
+        return super().create(prompt, max_tokens, temperature, stream)
+
+    async def acreate(self, prompt, max_tokens=100, temperature=0.5, stream=False):
+        self.calls += 1
+        return await super().acreate(prompt, max_tokens, temperature, stream)
+
+
+def caching_services(tmp_path):
+    upstream = CountingAIService(dimension=8)
+    cache = babyagi.TestAIService(
+        upstream, os.path.join(tmp_path, 'cache.sqlite'), os.path.join(tmp_path, 'embeddings.f32'), 8
+    )
+    return upstream, {'cache': cache, 'semantic': SemanticAIService(cache, threshold=0.99, dimension=8)}
+
+
+async def collect(tokens):
+    return [token async for token in tokens]
+
+
+@pytest.mark.parametrize('layer', ['cache', 'semantic'])
+def test_streaming_records_then_replays(tmp_path, layer):
+    upstream, layers = caching_services(tmp_path)
+    ai_service = layers[layer]
+    prompt = EXECUTION_PROMPT.format(objective='o', context='', task='a')
+    expected = upstream.create(prompt, 2000, 0.7)
+    upstream.calls = 0
+    recorded = list(ai_service.create(prompt, 2000, 0.7, stream=True))
+    replayed = list(ai_service.create(prompt, 2000, 0.7, stream=True))
+    assert ''.join(recorded).strip() == ''.join(replayed).strip() == expected
+    assert len(replayed) > 1
+    assert ai_service.create(prompt, 2000, 0.7) == expected
+    assert upstream.calls == 1
+
+
+@pytest.mark.parametrize('layer', ['cache', 'semantic'])
+def test_async_streaming_records_then_replays(tmp_path, layer):
+    upstream, layers = caching_services(tmp_path)
+    ai_service = layers[layer]
+    prompt = EXECUTION_PROMPT.format(objective='o', context='', task='a')
+    expected = upstream.create(prompt, 2000, 0.7)
+    upstream.calls = 0
+
+    async def run():
+        recorded = await collect(await ai_service.acreate(prompt, 2000, 0.7, stream=True))
+        replayed = await collect(await ai_service.acreate(prompt, 2000, 0.7, stream=True))
+        return recorded, replayed, await ai_service.acreate(prompt, 2000, 0.7)
+
+    recorded, replayed, response = asyncio.run(run())
+    assert ''.join(recorded).strip() == ''.join(replayed).strip() == response == expected
+    assert len(replayed) > 1
+    assert upstream.calls == 1
+
+
+def simulated_run(seed):
+    baby_agi = BabyAGI('Solve world hunger.', SimulatedAIService(seed=seed, dimension=8), NumpyService(dimension=8))
+    baby_agi.run('Develop a task list.', iterations=4)
+    return [(t.id, t.name, t.result) for t in baby_agi.vector_service.load_tasks()], [
+        t.name for t in baby_agi.task_list
+    ]
+
+
+def test_simulated_runs_are_deterministic_per_seed():
+    assert simulated_run(seed=1) == simulated_run(seed=1)
+    assert simulated_run(seed=1) != simulated_run(seed=2)
+    embeddings = SimulatedAIService(seed=1, dimension=8).get_ada_embeddings(['a', 'b'])
+    assert embeddings == SimulatedAIService(seed=1, dimension=8).get_ada_embeddings(['a', 'b'])
+    assert embeddings != SimulatedAIService(seed=2, dimension=8).get_ada_embeddings(['a', 'b'])
+
+
+class FailureCountingAIService(SimulatedAIService):
+    failures = 0
+
+    def fail(self):
+        try:
+            super().fail()
+        except babyagi.SIMULATED_ERRORS:
+            self.failures += 1
+            raise
+
+
+def test_simulated_errors_go_through_the_retry_path():
+    prompt = EXECUTION_PROMPT.format(objective='o', context='', task='a')
+    ai_service = FailureCountingAIService(
+        seed=3, dimension=8, error_rate=0.5, max_retries=50, backoff=0.001, max_backoff=0.001
+    )
+    responses = [ai_service.create(prompt) for _ in range(10)]
+    assert ai_service.failures > 0
+    assert responses == [SimulatedAIService(seed=3, dimension=8).create(prompt)] * 10
+    assert asyncio.run(ai_service.acreate(prompt)) == responses[0]
+    with pytest.raises(babyagi.SIMULATED_ERRORS):
+        SimulatedAIService(dimension=8, error_rate=1.0, max_retries=2, backoff=0.001, max_backoff=0.001).create(prompt)